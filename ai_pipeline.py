@@ -1,34 +1,300 @@
 import requests
 import json
 import re
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-OLLAMA_URL = "http://ollama:11434/api/generate"
+from llm_cache import cache_lookup, cache_store
+from llm_client import get_client, failover, CircuitOpenError
+from prefilter import prefilter_message
+from metrics import (
+    STAGE_SECONDS, LLM_REQUEST_SECONDS, LLM_REQUESTS, LLM_TOKENS, JSON_PARSE, MESSAGES_PROCESSED, IN_FLIGHT,
+    LLM_STREAM_STOPS, CLASSIFY_BATCHES,
+)
+from json_stream import JsonObjectScanner, first_json_object
+
+OLLAMA_URL = "http://ollama:11434/api/chat"
 MODEL_NAME = "gemma3:4b"
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# Pipeline modes:
+# - two_stage: one LLM call to classify the message, and one more to extract
+#   the features of positive messages
+# - single_pass: one LLM call returning both, as structured JSON
+PIPELINE_MODES = ["two_stage", "single_pass"]
+
+# Bump these whenever the prompts of a mode change, so that cached results from
+# the old prompts are not reused
+PROMPT_VERSION = 2
+SINGLE_PASS_PROMPT_VERSION = 2
+
+# The instructions and examples of each prompt are a fixed system message, and
+# the message to analyze is the user message: Ollama keeps the KV cache of the
+# common prefix between requests, so the instructions are evaluated only once
+# while the model stays loaded (see keep_alive and ollama_preload).
+
+# Can be changed with pipeline_init
+settings = {
+    # stream the LLM responses, and stop reading them as soon as the answer is
+    # complete (the classification word, or the closing brace of the JSON)
+    "stream": True,
+    # how long Ollama keeps the model (and its prompt cache) loaded after a request
+    "keep_alive": "30m",
+    # max messages classified per LLM call by process_messages_concurrently in
+    # two_stage mode (1: one at a time)
+    "classify_batch_size": 1,
+    # context window of the Ollama model (num_ctx), batches are sized to fit in it
+    "context_tokens": 4096,
+}
+
+# Current max classification batch size per backend, see process_batch: halved
+# when an answer can't be parsed, grown back by one after every good one
+_batch_limits = {}
+
+# LLM token usage of the current thread, see reset_usage/get_usage
+_usage = threading.local()
+
+def pipeline_init(stream=True, keep_alive="30m", classify_batch_size=1, context_tokens=4096):
+    settings["stream"] = stream
+    settings["keep_alive"] = keep_alive
+    settings["classify_batch_size"] = max(1, int(classify_batch_size))
+    settings["context_tokens"] = context_tokens
+    _batch_limits.clear()
+
+def get_model_name(model):
+    return GEMINI_MODEL_NAME if model == "gemini" else MODEL_NAME
+
+def get_prompt_version(mode):
+    if mode == "single_pass":
+        return f"single_pass-{SINGLE_PASS_PROMPT_VERSION}"
+    return f"two_stage-{PROMPT_VERSION}"
+
+# Recorded with each processed message, to find the ones to re-extract when
+# the model or the prompts change
+def get_processed_with(model, mode):
+    return {"model": get_model_name(model), "prompt_version": get_prompt_version(mode)}
+
+def reset_usage():
+    _usage.calls = 0
+    _usage.prompt_tokens = 0
+    _usage.completion_tokens = 0
+
+# Returns the LLM calls and tokens used by the current thread since reset_usage
+def get_usage():
+    return {
+        "calls": getattr(_usage, "calls", 0),
+        "prompt_tokens": getattr(_usage, "prompt_tokens", 0),
+        "completion_tokens": getattr(_usage, "completion_tokens", 0),
+    }
 
-def process_message(db, msg, model='ollama', gemini_key=None):
+def _add_usage(backend, prompt_tokens, completion_tokens):
+    LLM_TOKENS.inc(prompt_tokens or 0, backend=backend, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens or 0, backend=backend, kind="completion")
+    _usage.calls = getattr(_usage, "calls", 0) + 1
+    _usage.prompt_tokens = getattr(_usage, "prompt_tokens", 0) + (prompt_tokens or 0)
+    _usage.completion_tokens = getattr(_usage, "completion_tokens", 0) + (completion_tokens or 0)
+
+# Pass db=None to skip the LLM result cache
+def process_message(db, msg, model='ollama', gemini_key=None, mode='two_stage'):
+    result, prefilter_decision = _decide_without_llm(db, msg, model, mode)
+    if result is not None:
+        return result
    
-    classification_res = classify_message(msg, model, gemini_key)
-    
-    
-    if not classification_res:
+    decided_by = "llm"
+    if prefilter_decision == "accept" and mode == "two_stage":
+        # obvious positives skip the classification
+        extracted_features = extract_features(msg["text"], model, gemini_key)
+        decided_by = "prefilter"
+    elif mode == "single_pass":
+        extracted_features = classify_and_extract(msg["text"], model, gemini_key)
+    else:
+        classification_res = classify_message(msg["text"], model, gemini_key)
+        extracted_features = None
+        if classification_res:
+            extracted_features = extract_features(msg["text"], model, gemini_key)
+
+    return _finish_message(db, msg, extracted_features, model, mode, decided_by)
+
+# Returns (result, None) for the messages decided without the LLM: rejected by
+# the pre-filter, or found in the LLM result cache. Otherwise (None, pre-filter
+# decision). Results record in "decided_by" whether the classification comes
+# from the pre-filter or the LLM.
+def _decide_without_llm(db, msg, model, mode):
+    # obvious negatives never reach the LLM
+    prefilter_decision = prefilter_message(db, msg["text"], mode)
+    if prefilter_decision == "reject":
+        MESSAGES_PROCESSED.inc(outcome="rejected")
         return {
             "message": msg["text"],
             "extracted_features": None,
+            "decided_by": "prefilter",
+        }, None
+
+    if db is not None:
+        cached = cache_lookup(db, msg["text"], get_model_name(model), get_prompt_version(mode))
+        if cached is not None:
+            MESSAGES_PROCESSED.inc(outcome="cached")
+            return {
+                "message": msg["text"],
+                "extracted_features": cached["extracted_features"],
+                "decided_by": cached.get("decided_by", "llm"),
+            }, None
+    return None, prefilter_decision
+
+# Result of a message processed by the LLM, cached unless the extraction failed
+def _finish_message(db, msg, extracted_features, model, mode, decided_by="llm"):
+    # don't cache failed extractions, they should be retried
+    if extracted_features is not None and is_extraction_error(extracted_features):
+        MESSAGES_PROCESSED.inc(outcome="extraction_error")
+        return {
+            "message": msg["text"],
+            "extracted_features": extracted_features,
+            "decided_by": decided_by,
         }
 
-    extracted_features = extract_features(msg, model, gemini_key)
+    MESSAGES_PROCESSED.inc(outcome="negative" if extracted_features is None else "positive")
+    if db is not None:
+        cache_store(db, msg["text"], get_model_name(model), get_prompt_version(mode),
+                    {"extracted_features": extracted_features, "decided_by": decided_by})
     
     return {
         "message": msg["text"],
-        "extracted_features": extracted_features
+        "extracted_features": extracted_features,
+        "decided_by": decided_by,
     }
 
-def extract_features(msg, model, gemini_key):
-    extraction_prompt = f"""
-    Extract rental features from this apartment/room announcement and output ONLY valid JSON.
+def is_extraction_error(extracted_features):
+    other = extracted_features.get("other") if isinstance(extracted_features, dict) else None
+    return not isinstance(extracted_features, dict) or (isinstance(other, dict) and "extraction_error" in other)
+
+# A result of process_message whose extraction failed: it must not be stored,
+# the message is retried once its lease expires
+def is_failed_result(result):
+    return result["extracted_features"] is not None and is_extraction_error(result["extracted_features"])
+
+# Runs process_message over an iterable of messages, keeping at most `concurrency`
+# LLM requests in flight. The iterable is consumed lazily, so a huge cursor is
+# never loaded in memory (backpressure). A failing message does not stop the run:
+# on_error is called for it and the remaining messages keep being processed.
+# In two_stage mode with classify_batch_size > 1, the messages are classified
+# in batches, see process_batch.
+def process_messages_concurrently(db, messages, on_result, on_error=None, model='ollama', gemini_key=None, concurrency=4, mode='two_stage'):
+    concurrency = max(1, int(concurrency))
+    if mode == "two_stage" and settings["classify_batch_size"] > 1:
+        tasks = _batch_tasks(db, messages, model, gemini_key)
+    else:
+        tasks = (([msg], partial(_process_one, db, msg, model, gemini_key, mode)) for msg in messages)
+    in_flight = {}
+    # tasks returned by other tasks, run before new messages are taken
+    follow_ups = deque()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # a task is ([messages], fn), fn returns per message a result, an
+        # exception, or a follow-up task for it
+        def submit_next():
+            task = follow_ups.popleft() if follow_ups else next(tasks, None)
+            if task is None:
+                return False
+            batch, fn = task
+            in_flight[executor.submit(fn)] = batch
+            IN_FLIGHT.inc(len(batch))
+            return True
+
+        while len(in_flight) < concurrency and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                IN_FLIGHT.dec(len(batch))
+                try:
+                    results = future.result()
+                except Exception as e:
+                    results = [e] * len(batch)
+                for msg, result in zip(batch, results):
+                    if callable(result):
+                        follow_ups.append(([msg], result))
+                    elif isinstance(result, Exception):
+                        MESSAGES_PROCESSED.inc(outcome="error")
+                        print(f"Error processing message {msg.get('_id')}: {result}")
+                        if on_error:
+                            on_error(msg, result)
+                    else:
+                        on_result(msg, result)
+            while len(in_flight) < concurrency and submit_next():
+                pass
+
+def _process_one(db, msg, model, gemini_key, mode):
+    return [process_message(db, msg, model, gemini_key, mode)]
+
+# Groups the messages that need the LLM classification in batches of up to the
+# current batch limit of the backend, that also fit in the context window. The
+# others are yielded on their own, without waiting for a batch to fill.
+def _batch_tasks(db, messages, model, gemini_key):
+    batch = []
+    batch_tokens = 0
+    for msg in messages:
+        result, prefilter_decision = _decide_without_llm(db, msg, model, "two_stage")
+        if result is not None:
+            yield [msg], partial(list, [result])
+            continue
+        if prefilter_decision == "accept":
+            yield [msg], partial(_process_accepted, db, msg, model, gemini_key, "prefilter")
+            continue
+
+        tokens = _batch_item_tokens(msg["text"])
+        if batch and (len(batch) >= _batch_limit(model) or batch_tokens + tokens > _batch_token_budget(model)):
+            yield batch, partial(process_batch, db, batch, model, gemini_key)
+            batch = []
+            batch_tokens = 0
+        batch.append(msg)
+        batch_tokens += tokens
+    if batch:
+        yield batch, partial(process_batch, db, batch, model, gemini_key)
+
+def _process_accepted(db, msg, model, gemini_key, decided_by="llm"):
+    features = extract_features(msg["text"], model, gemini_key)
+    return [_finish_message(db, msg, features, model, "two_stage", decided_by)]
+
+# Classifies a batch of messages with one LLM call. If the call fails or the
+# answer doesn't have exactly one verdict per message, they are classified one
+# at a time instead. Returns per message its result if negative, the exception
+# raised, or for the positive ones the task extracting their features, so that
+# the extractions run in parallel.
+def process_batch(db, batch, model, gemini_key):
+    verdicts = None
+    if len(batch) > 1:
+        try:
+            verdicts = classify_batch([msg["text"] for msg in batch], model, gemini_key)
+        except Exception as e:
+            CLASSIFY_BATCHES.inc(backend=model, result="error")
+            print(f"Batched classification of {len(batch)} messages failed: {e!r}")
+    if verdicts is None:
+        verdicts = []
+        for msg in batch:
+            try:
+                verdicts.append(classify_message(msg["text"], model, gemini_key))
+            except Exception as e:
+                verdicts.append(e)
+
+    results = []
+    for msg, verdict in zip(batch, verdicts):
+        if isinstance(verdict, Exception):
+            results.append(verdict)
+        elif verdict:
+            results.append(partial(_process_accepted, db, msg, model, gemini_key))
+        else:
+            results.append(_finish_message(db, msg, None, model, "two_stage"))
+    return results
+
+EXTRACTION_SYSTEM_PROMPT = """
+    Extract rental features from the apartment/room announcement in the user message and output ONLY valid JSON.
 
     Required JSON structure:
-    {{
+    {
         "price_per_month": number or null,
         "room_type": "single" | "double" | null,
         "location": "string description" or null,
@@ -39,7 +305,7 @@ def extract_features(msg, model, gemini_key):
         "utilities_included": true | false | null,
         "amenities": ["wifi", "laundry", "parking", "elevator", "balcony", "kitchen"],
         "other": ["string", "string2"...],
-    }}
+    }
     
     Rules:
     - Extract exact prices in euros (use numbers only, no currency symbols)
@@ -51,7 +317,7 @@ def extract_features(msg, model, gemini_key):
     Example:
     Input: "Stanza doppia via Matteotti - per studentesse, al secondo piano. Costo 260€ al mese spese incluse. Wifi, ascensore. Disponibile settembre.
     Output:
-    {{
+    {
         "price_per_month": 260,
         "room_type": "double", 
         "location": "via Matteotti",
@@ -62,28 +328,28 @@ def extract_features(msg, model, gemini_key):
         "utilities_included": true,
         "amenities": ["wifi", "elevator"],
         "other": [ "Second floor" ]
-    }}
-    
-    Extract from this message:
-    {msg}
+    }
     """
-   
-    if model == "ollama":
-        res = call_ollama(OLLAMA_URL, MODEL_NAME, extraction_prompt)
-    elif model == "gemini":
-        res = call_gemini(extraction_prompt, gemini_key)
 
+def extract_features(text, model, gemini_key):
+    with STAGE_SECONDS.time(stage="extract", backend=model):
+        res = call_llm(model, text, gemini_key, system=EXTRACTION_SYSTEM_PROMPT, scanner=JsonObjectScanner)
+
+    with STAGE_SECONDS.time(stage="json_parse", backend=model):
+        features = parse_features_response(res)
+    JSON_PARSE.inc(backend=model, result="error" if is_extraction_error(features) else "ok")
+    return features
+
+# Parses the JSON features out of an LLM response. On failure, returns empty
+# features with the error and raw response in "other".
+def parse_features_response(res):
     try:
         # Strip any thinking tags and extra content
         cleaned_response = re.sub(r'<think>.*?</think>', '', res, flags=re.DOTALL).strip()
         
-        # Try to find JSON in the response
-        import json
-        
-        # Look for JSON object in the response
-        json_match = re.search(r'\{.*\}', cleaned_response, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
+        # Look for the first JSON object in the response, ignoring any chatter around it
+        json_str = first_json_object(cleaned_response)
+        if json_str:
             return json.loads(json_str)
         else:
             # Fallback: try to parse the entire cleaned response
@@ -92,22 +358,24 @@ def extract_features(msg, model, gemini_key):
     except json.JSONDecodeError as e:
         print(f"JSON decode error: {e}")
         print(f"Raw response: {res}")
-        return {
-            "price_per_month": None,
-            "room_type": None,
-            "location": None,
-            "target_gender": None,
-            "target_audience": None,
-            "available_from": None,
-            "contract_duration": None,
-            "utilities_included": None,
-            "amenities": [],
-            "other": {"extraction_error": "Failed to parse response", "raw_response": res}
-        }
+        return empty_features({"extraction_error": "Failed to parse response", "raw_response": res})
+
+def empty_features(other):
+    return {
+        "price_per_month": None,
+        "room_type": None,
+        "location": None,
+        "target_gender": None,
+        "target_audience": None,
+        "available_from": None,
+        "contract_duration": None,
+        "utilities_included": None,
+        "amenities": [],
+        "other": other
+    }
 
-def classify_message(msg, model, gemini_key):
-    classification_prompt = f"""
-        Analyze the following message and determine if it's an apartment/room rental announcement.
+CLASSIFICATION_SYSTEM_PROMPT = """
+        Analyze the user message and determine if it's an apartment/room rental announcement.
         Respond only with "YES" if it's clearly an apartment/room rental announcement and "NO" otherwise.
         Respond with "NO" if it is an announcement for people LOOKING for apartments.
         If it's a strange message that doesn't fall into any category clearly or doesn't contain key information (especially PRICE), then respond with MALFORMED and explain why.
@@ -139,21 +407,297 @@ def classify_message(msg, model, gemini_key):
         Scrivetemi se interessati!
         Output 3:
         MALFORMED, no price detected.
-    
-        The following text is the message to be analyzed:
-        {msg}
     """
-   
-    if model == "ollama":
-        res = call_ollama(OLLAMA_URL, MODEL_NAME, classification_prompt)
-    elif model == "gemini":
-        res = call_gemini(classification_prompt, gemini_key)
+
+def classify_message(text, model, gemini_key):
+    with STAGE_SECONDS.time(stage="classify", backend=model):
+        res = call_llm(model, text, gemini_key, system=CLASSIFICATION_SYSTEM_PROMPT, scanner=ClassificationScanner)
     classification_res = res.strip().upper().startswith("YES")
     return classification_res # for now, we only handle positives
 
 
-def call_gemini(prompt_text, api_key):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+CLASSIFICATION_BATCH_SYSTEM_PROMPT = CLASSIFICATION_SYSTEM_PROMPT + """
+        The user message contains several messages to analyze, each one introduced by its number in square brackets, e.g. [1].
+        Analyze each of them as above, and answer with one line per message, in order: its number, a colon and the answer. For example:
+        1: YES
+        2: NO
+        3: MALFORMED, no price detected.
+        Answer every message, and don't output anything else.
+    """
+
+# Rough token count of a text, about 3 characters per token for the Italian
+# texts with emoji of the chats
+def estimate_tokens(text):
+    return len(text) // 3 + 1
+
+# Tokens taken by a message in a batch: its text, its number, and its answer line
+def _batch_item_tokens(text):
+    return estimate_tokens(text) + 12
+
+def _batch_limit(model):
+    return _batch_limits.get(model, settings["classify_batch_size"])
+
+# Gemini's context window is much larger than any batch
+def _batch_token_budget(model):
+    if model != "ollama":
+        return float("inf")
+    # 10% margin for the errors of the estimate
+    return settings["context_tokens"] * 0.9 - estimate_tokens(CLASSIFICATION_BATCH_SYSTEM_PROMPT)
+
+def format_classification_batch(texts):
+    return "\n\n".join(f"[{i}]\n{text}" for i, text in enumerate(texts, 1))
+
+# "1: YES", "2. NO", "[3] MALFORMED, ..."
+BATCH_VERDICT_PATTERN = re.compile(r"(?:\[(\d+)\]|(\d+)\s*[:.)])\s*(YES|NO|MALFORMED)")
+
+def _batch_verdicts(answer):
+    for match in BATCH_VERDICT_PATTERN.finditer(answer):
+        yield int(match.group(1) or match.group(2)), match.group(3)
+
+# Returns the verdicts (True for YES) of a batched classification, in order, or
+# None if the answer doesn't have exactly one verdict for each of the `count`
+# messages. Works on answers with the newlines stripped, too.
+def parse_classification_batch(answer, count):
+    verdicts = {}
+    for number, word in _batch_verdicts(answer):
+        if number in verdicts or not 1 <= number <= count:
+            return None
+        verdicts[number] = word == "YES"
+    if len(verdicts) != count:
+        return None
+    return [verdicts[number] for number in range(1, count + 1)]
+
+# Classifies several messages with one LLM call, so that the instructions and
+# the request overhead are paid once per batch. Returns a verdict per message,
+# or None if the answer can't be parsed.
+def classify_batch(texts, model, gemini_key):
+    with STAGE_SECONDS.time(stage="classify_batch", backend=model):
+        res = call_llm(model, format_classification_batch(texts), gemini_key,
+                       system=CLASSIFICATION_BATCH_SYSTEM_PROMPT,
+                       scanner=partial(BatchClassificationScanner, len(texts)))
+    verdicts = parse_classification_batch(res, len(texts))
+    limit = _batch_limit(model)
+    if verdicts is None:
+        CLASSIFY_BATCHES.inc(backend=model, result="mismatch")
+        _batch_limits[model] = max(1, min(limit, len(texts)) // 2)
+        print(f"Could not parse the classification of a batch of {len(texts)} messages, batch limit now {_batch_limits[model]}")
+    else:
+        CLASSIFY_BATCHES.inc(backend=model, result="ok")
+        _batch_limits[model] = min(settings["classify_batch_size"], limit + 1)
+    return verdicts
+
+
+# Stops a streamed batched classification once every message has its verdict
+class BatchClassificationScanner:
+    def __init__(self, count):
+        self.count = count
+        self.text = ""
+
+    def feed(self, chunk):
+        self.text += chunk
+        if "<think>" in self.text and "</think>" not in self.text:
+            return None
+        answer = re.sub(r'<think>.*?</think>', '', self.text, flags=re.DOTALL)
+        # every message answered, in whatever order
+        if {number for number, _ in _batch_verdicts(answer)} >= set(range(1, self.count + 1)):
+            return answer
+        return None
+
+
+# Stops a streamed classification at the first decisive word
+class ClassificationScanner:
+    WORDS = ("YES", "NO", "MALFORMED")
+
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, chunk):
+        self.text += chunk
+        if "<think>" in self.text and "</think>" not in self.text:
+            return None
+        answer = re.sub(r'<think>.*?</think>', '', self.text, flags=re.DOTALL).lstrip().upper()
+        if answer and "<THINK>".startswith(answer):
+            # a <think> tag split across chunks
+            return None
+        for word in self.WORDS:
+            if answer.startswith(word):
+                return word
+        if answer and not any(word.startswith(answer) for word in self.WORDS):
+            # not going to be a decisive answer anyway
+            return answer
+        return None
+
+
+# JSON schema of the extracted features, used for structured output
+FEATURES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "price_per_month": {"type": ["number", "null"]},
+        "room_type": {"type": ["string", "null"], "enum": ["single", "double", "shared", None]},
+        "location": {"type": ["string", "null"]},
+        "target_gender": {"type": ["string", "null"], "enum": ["male", "female", "any", None]},
+        "target_audience": {"type": ["string", "null"], "enum": ["students", "professionals", "any", None]},
+        "available_from": {"type": ["string", "null"]},
+        "contract_duration": {"type": ["string", "null"]},
+        "utilities_included": {"type": ["boolean", "null"]},
+        "amenities": {"type": "array", "items": {"type": "string"}},
+        "other": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": [
+        "price_per_month", "room_type", "location", "target_gender", "target_audience",
+        "available_from", "contract_duration", "utilities_included", "amenities", "other",
+    ],
+}
+
+SINGLE_PASS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "classification": {"type": "string", "enum": ["YES", "NO", "MALFORMED"]},
+        "features": {**FEATURES_SCHEMA, "type": ["object", "null"]},
+    },
+    "required": ["classification", "features"],
+}
+
+SINGLE_PASS_SYSTEM_PROMPT = """
+    Analyze the user message and determine if it's an apartment/room rental announcement, then extract its features.
+    Output ONLY valid JSON with two fields:
+    - "classification": "YES" if it's clearly an apartment/room rental announcement, "NO" otherwise (also for people LOOKING for apartments),
+      "MALFORMED" if it doesn't fall into any category clearly or doesn't contain key information (especially PRICE).
+    - "features": the rental features if classification is "YES", null otherwise.
+
+    Features rules:
+    - Extract exact prices in euros (use numbers only, no currency symbols)
+    - For room_type: "single" = one person, "double" = two people, "shared" = shared room
+    - amenities can be: "wifi", "laundry", "parking", "elevator", "balcony", "kitchen"
+    - Put any non-standard features in "other"
+    - Use null for missing information
+
+    Example:
+    Input: "Stanza doppia via Matteotti - per studentesse, al secondo piano. Costo 260€ al mese spese incluse. Wifi, ascensore. Disponibile settembre.
+    Output:
+    {
+        "classification": "YES",
+        "features": {
+            "price_per_month": 260,
+            "room_type": "double",
+            "location": "via Matteotti",
+            "target_gender": "female",
+            "target_audience": "students",
+            "available_from": "settembre",
+            "contract_duration": null,
+            "utilities_included": true,
+            "amenities": ["wifi", "elevator"],
+            "other": [ "Second floor" ]
+        }
+    }
+
+    Input: "#cerco stanza singola a Trento da settembre, budget 350€"
+    Output:
+    { "classification": "NO", "features": null }
+    """
+
+# Classifies the message and extracts its features with a single LLM call.
+# Returns the features of rental announcements, None otherwise.
+def classify_and_extract(text, model, gemini_key):
+    with STAGE_SECONDS.time(stage="classify_extract", backend=model):
+        res = call_llm(model, text, gemini_key, system=SINGLE_PASS_SYSTEM_PROMPT, schema=SINGLE_PASS_SCHEMA,
+                       scanner=JsonObjectScanner)
+
+    try:
+        with STAGE_SECONDS.time(stage="json_parse", backend=model):
+            result = json.loads(first_json_object(res) or res)
+        JSON_PARSE.inc(backend=model, result="ok")
+    except json.JSONDecodeError as e:
+        JSON_PARSE.inc(backend=model, result="error")
+        print(f"JSON decode error: {e}")
+        print(f"Raw response: {res}")
+        return empty_features({"extraction_error": "Failed to parse response", "raw_response": res})
+
+    if str(result.get("classification", "")).strip().upper() != "YES":
+        return None
+    features = result.get("features")
+    if not isinstance(features, dict):
+        return empty_features({"extraction_error": "Missing features", "raw_response": res})
+    return features
+
+# Converts a JSON schema to the OpenAPI subset accepted by Gemini's responseSchema,
+# where nullable fields are marked with "nullable" instead of a "null" type
+def to_gemini_schema(schema):
+    converted = {}
+    for key, value in schema.items():
+        if key == "type" and isinstance(value, list):
+            types = [t for t in value if t != "null"]
+            converted["type"] = types[0]
+            if "null" in value:
+                converted["nullable"] = True
+        elif key == "enum":
+            converted["enum"] = [v for v in value if v is not None]
+        elif key == "properties":
+            converted["properties"] = {k: to_gemini_schema(v) for k, v in value.items()}
+        elif key == "items":
+            converted["items"] = to_gemini_schema(value)
+        else:
+            converted[key] = value
+    if "enum" in converted:
+        converted["format"] = "enum"
+    return converted
+
+
+# Calls the given backend, or its failover backend (see llm_client.failover) if
+# it is failing. system: the fixed instructions, prompt: the message.
+# schema: if given, the response is constrained to JSON of this schema.
+# scanner: class of the object deciding when a streamed response is complete
+# (see _read_stream), used when settings["stream"] is on
+def call_llm(model, prompt, gemini_key, schema=None, scanner=None, system=None):
+    try:
+        return _call_backend(model, prompt, gemini_key, schema, scanner, system)
+    except (CircuitOpenError, requests.RequestException) as e:
+        fallback = failover.get(model)
+        if not fallback:
+            raise
+        print(f"{model} failed ({e}), failing over to {fallback}")
+        return _call_backend(fallback, prompt, gemini_key, schema, scanner, system)
+
+def _call_backend(model, prompt, gemini_key, schema, scanner=None, system=None):
+    if model not in ("ollama", "gemini"):
+        raise ValueError(f"Unknown model: {model}")
+    scanner = scanner() if scanner and settings["stream"] else None
+    try:
+        with LLM_REQUEST_SECONDS.time(backend=model):
+            if model == "ollama":
+                response = call_ollama(OLLAMA_URL, MODEL_NAME, prompt, format=schema, scanner=scanner, system=system)
+            else:
+                response = call_gemini(prompt, gemini_key, response_schema=to_gemini_schema(schema) if schema else None,
+                                       scanner=scanner, system=system)
+    except Exception:
+        LLM_REQUESTS.inc(backend=model, status="error")
+        raise
+    LLM_REQUESTS.inc(backend=model, status="ok")
+    return response
+
+# Reads a streamed response chunk by chunk, feeding the scanner, until it returns
+# the answer. The connection is then closed, which stops the generation.
+# Returns the full text if the stream ends first.
+def _read_stream(backend, response, chunks, scanner):
+    text = []
+    try:
+        for chunk in chunks:
+            text.append(chunk)
+            result = scanner.feed(chunk)
+            if result is not None:
+                LLM_STREAM_STOPS.inc(backend=backend)
+                return result
+    finally:
+        response.close()
+    return "".join(text)
+
+# response_schema: if given, the response is constrained to JSON of this schema.
+# scanner: if given, the response is streamed, see _read_stream
+# system: system instruction
+def call_gemini(prompt_text, api_key, response_schema=None, scanner=None, system=None):
+    if scanner:
+        return _stream_gemini(prompt_text, api_key, response_schema, scanner, system)
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL_NAME}:generateContent"
     headers = {
         "Content-Type": "application/json",
         "X-goog-api-key": api_key
@@ -169,10 +713,15 @@ def call_gemini(prompt_text, api_key):
             }
         ]
     }
+    if system:
+        payload["systemInstruction"] = {"parts": [{"text": system}]}
+    if response_schema:
+        payload["generationConfig"] = _gemini_generation_config(response_schema)
 
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = get_client("gemini").post(url, json=payload, headers=headers)
     result = response.json()
+    usage = result.get("usageMetadata", {})
+    _add_usage("gemini", usage.get("promptTokenCount"), usage.get("candidatesTokenCount"))
 
     # Gemini response structure example:
     # {
@@ -190,25 +739,111 @@ def call_gemini(prompt_text, api_key):
 
     return cleaned_response
 
-def call_ollama(url, model, prompt):
+def _gemini_generation_config(response_schema):
+    return {
+        "responseMimeType": "application/json",
+        "responseSchema": response_schema,
+    }
+
+def _stream_gemini(prompt_text, api_key, response_schema, scanner, system):
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL_NAME}:streamGenerateContent?alt=sse"
+    payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
+    if system:
+        payload["systemInstruction"] = {"parts": [{"text": system}]}
+    if response_schema:
+        payload["generationConfig"] = _gemini_generation_config(response_schema)
+    response = get_client("gemini").post(url, json=payload, stream=True, headers={
+        "Content-Type": "application/json",
+        "X-goog-api-key": api_key,
+    })
+    response.encoding = "utf-8"
+
+    # usageMetadata is cumulative, the last one seen is kept
+    usage = {}
+
+    def chunks():
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            usage.update(data.get("usageMetadata") or {})
+            parts = (data.get("candidates") or [{}])[0].get("content", {}).get("parts", [])
+            yield "".join(part.get("text", "") for part in parts)
+
+    text = _read_stream("gemini", response, chunks(), scanner)
+    _add_usage("gemini", usage.get("promptTokenCount"), usage.get("candidatesTokenCount"))
+    return text.strip()
+
+# Calls Ollama's /api/chat. format: "json" or a JSON schema to constrain the
+# response to. scanner: if given, the response is streamed, see _read_stream.
+# system: system message, identical across calls so that its KV cache is reused
+def call_ollama(url, model, prompt, format=None, scanner=None, system=None):
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
     payload = {
         "model": model,
-        "prompt": prompt,
+        "messages": messages,
         "stream": False,
+        "keep_alive": settings["keep_alive"],
         "options": {
             "temperature": 0.1,
             "top_p": 0.9,
+            # the same in every request, a different one reloads the model
+            "num_ctx": settings["context_tokens"],
         }
     }
+    if format:
+        payload["format"] = format
     headers = {
         "Content-Type": "application/json"
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    if scanner:
+        return _stream_ollama(url, payload, headers, scanner)
+    response = get_client("ollama").post(url, json=payload, headers=headers)
     result = response.json()
+    _add_usage("ollama", result.get("prompt_eval_count"), result.get("eval_count"))
 
-    raw_response = result.get("response", "").strip().replace("\n", "")
+    raw_response = result.get("message", {}).get("content", "").strip().replace("\n", "")
     # strip thinking process
     cleaned_response = re.sub(r'<think>.*?</think>', '', raw_response, flags=re.DOTALL).strip()
 
     return cleaned_response
+
+def _stream_ollama(url, payload, headers, scanner):
+    response = get_client("ollama").post(url, json={**payload, "stream": True}, headers=headers, stream=True)
+
+    # Ollama reports the token counts in the last line only: when the stream is
+    # stopped early, the completion tokens are counted from the chunks (one
+    # token each) and the prompt tokens are unknown
+    usage = {"prompt_eval_count": None, "eval_count": 0}
+
+    def chunks():
+        for line in response.iter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get("done"):
+                usage.update(prompt_eval_count=data.get("prompt_eval_count"), eval_count=data.get("eval_count"))
+            else:
+                usage["eval_count"] += 1
+            yield data.get("message", {}).get("content", "")
+
+    text = _read_stream("ollama", response, chunks(), scanner)
+    _add_usage("ollama", usage["prompt_eval_count"], usage["eval_count"])
+    # strip thinking process
+    return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
+
+# Loads the model in Ollama ahead of the first message, so that it doesn't pay
+# the cold load. A chat request without messages only loads the model.
+def ollama_preload():
+    try:
+        get_client("ollama").post(OLLAMA_URL, json={
+            "model": MODEL_NAME,
+            "messages": [],
+            "keep_alive": settings["keep_alive"],
+            "options": {"num_ctx": settings["context_tokens"]},
+        })
+        print(f"Ollama model {MODEL_NAME} loaded.")
+    except Exception as e:
+        print(f"Could not preload the Ollama model: {e}")
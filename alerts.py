@@ -0,0 +1,342 @@
+import bisect
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, UpdateOne
+
+from geocoding import CAMPUSES, distance_km
+from rate_limit import RateLimiter
+from rentals import ROOM_TYPES, GENDERS, AMENITIES
+
+# Saved-search alerts: users save searches, and get a Telegram DM when a new
+# rental matches one of them.
+#
+# Searches are stored in the users collection, in the same terms as the
+# /processed_messages filters:
+# {
+#     "user_id": Telegram username or id, where the alerts are sent,
+#     "searches": [{
+#         "id": "string",
+#         "max_price": float or None,
+#         "room_type": "single" | "double" | "shared" | None,
+#         "target_gender": "male" | "female" | None,
+#         "amenities": [AMENITIES],
+#         "near": campus or None, "max_distance_km": float,
+#         "created_at": datetime,
+#     }],
+# }
+#
+# Matches are queued in the alerts collection, one per user and rental, and
+# the AlertSender delivers them.
+
+ALERTS_COLLECTION = "alerts"
+
+MAX_ATTEMPTS = 3
+
+# Can be changed with alerts_init
+settings = {
+    "enabled": False,
+    "max_age_hours": 72,
+}
+
+
+def _as_utc(date):
+    if date is not None and date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
+
+# Validates a saved search sent to the API, raises ValueError
+def parse_search(data):
+    search = {
+        "id": uuid.uuid4().hex[:8],
+        "max_price": float(data["max_price"]) if data.get("max_price") is not None else None,
+        "room_type": data.get("room_type") or None,
+        "target_gender": data.get("target_gender") or None,
+        "amenities": list(data.get("amenities") or []),
+        "near": data.get("near") or None,
+        "max_distance_km": float(data.get("max_distance_km") or 2),
+        "created_at": datetime.now(timezone.utc),
+    }
+    if search["target_gender"] == "any":
+        search["target_gender"] = None
+    if search["room_type"] not in (None, *ROOM_TYPES):
+        raise ValueError(f"Invalid room_type, use one of {', '.join(ROOM_TYPES)}")
+    if search["target_gender"] not in (None, *GENDERS):
+        raise ValueError(f"Invalid target_gender, use one of {', '.join(GENDERS)}")
+    if any(amenity not in AMENITIES for amenity in search["amenities"]):
+        raise ValueError(f"Invalid amenities, use some of {', '.join(AMENITIES)}")
+    if search["near"] not in (None, *CAMPUSES):
+        raise ValueError(f"Invalid near, use one of {', '.join(CAMPUSES)}")
+    return search
+
+# Same semantics as the /processed_messages filters
+def search_matches(search, rental):
+    if search["max_price"] is not None:
+        if rental.get("price_per_month") is None or rental["price_per_month"] > search["max_price"]:
+            return False
+    if search["room_type"] and rental.get("room_type") != search["room_type"]:
+        return False
+    if search["target_gender"] and rental.get("target_gender") not in (search["target_gender"], "any"):
+        return False
+    if any(amenity not in rental.get("amenities", []) for amenity in search["amenities"]):
+        return False
+    if search["near"]:
+        if not rental.get("location_point"):
+            return False
+        lon, lat = rental["location_point"]["coordinates"]
+        campus = CAMPUSES[search["near"]]
+        if distance_km(campus["lat"], campus["lon"], lat, lon) > search["max_distance_km"]:
+            return False
+    return True
+
+
+# Inverted index over the saved searches. Each search is posted under a single
+# key, its most selective predicate (an amenity, then the room type, the
+# campus, the gender); a rental is then checked only against the searches
+# posted under its own keys. Searches with just a price ceiling are kept sorted
+# by price, and those without predicates match every rental.
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}
+        # sorted [(max_price, user_id, search_id)]
+        self.by_price = []
+        self.match_all = {}
+        self.searches = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _anchor(search):
+        if search["amenities"]:
+            return ("amenity", search["amenities"][0])
+        if search["room_type"]:
+            return ("room_type", search["room_type"])
+        if search["near"]:
+            return ("near", search["near"])
+        if search["target_gender"]:
+            return ("gender", search["target_gender"])
+        return None
+
+    # The keys a rental can match searches under
+    @staticmethod
+    def _rental_keys(rental):
+        keys = [("amenity", amenity) for amenity in rental.get("amenities", [])]
+        if rental.get("room_type"):
+            keys.append(("room_type", rental["room_type"]))
+        if rental.get("location_point"):
+            keys += [("near", campus) for campus in CAMPUSES]
+        if rental.get("target_gender") == "any":
+            keys += [("gender", "male"), ("gender", "female")]
+        elif rental.get("target_gender"):
+            keys.append(("gender", rental["target_gender"]))
+        return keys
+
+    def add(self, user_id, search):
+        key = (user_id, search["id"])
+        with self.lock:
+            self.searches[key] = search
+            anchor = self._anchor(search)
+            if anchor:
+                self.postings.setdefault(anchor, {})[key] = search
+            elif search["max_price"] is not None:
+                bisect.insort(self.by_price, (search["max_price"], user_id, search["id"]))
+            else:
+                self.match_all[key] = search
+
+    def remove(self, user_id, search_id):
+        key = (user_id, search_id)
+        with self.lock:
+            search = self.searches.pop(key, None)
+            if search is None:
+                return
+            anchor = self._anchor(search)
+            if anchor:
+                self.postings[anchor].pop(key, None)
+            elif search["max_price"] is not None:
+                self.by_price.remove((search["max_price"], user_id, search_id))
+            else:
+                self.match_all.pop(key, None)
+
+    # Replaces the searches of a user with `searches`
+    def set_user(self, user_id, searches):
+        with self.lock:
+            current = [search_id for (uid, search_id) in self.searches if uid == user_id]
+        for search_id in current:
+            self.remove(user_id, search_id)
+        for search in searches:
+            self.add(user_id, search)
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.by_price.clear()
+            self.match_all.clear()
+            self.searches.clear()
+
+    # Returns [(user_id, search)] of the searches matching the rental
+    def match(self, rental):
+        with self.lock:
+            candidates = dict(self.match_all)
+            for key in self._rental_keys(rental):
+                candidates.update(self.postings.get(key, {}))
+            if rental.get("price_per_month") is not None:
+                start = bisect.bisect_left(self.by_price, (rental["price_per_month"],))
+                for _, user_id, search_id in self.by_price[start:]:
+                    candidates[(user_id, search_id)] = self.searches[(user_id, search_id)]
+        return [(user_id, search) for (user_id, _), search in candidates.items() if search_matches(search, rental)]
+
+
+_index = SearchIndex()
+
+
+def alerts_init(db, enabled=False, max_age_hours=72):
+    settings["enabled"] = enabled
+    settings["max_age_hours"] = max_age_hours
+
+    db[ALERTS_COLLECTION].create_index([("user_id", ASCENDING), ("rental_id", ASCENDING)], unique=True)
+    db[ALERTS_COLLECTION].create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+    db["users"].create_index("user_id")
+    alerts_reload(db)
+
+# Rebuilds the index of the saved searches from the users collection, e.g.
+# after a restore
+def alerts_reload(db):
+    _index.clear()
+    for user in db["users"].find({"searches.0": {"$exists": True}}, {"user_id": 1, "searches": 1}):
+        _index.set_user(user["user_id"], user["searches"])
+
+
+def get_searches(db, user_id):
+    user = db["users"].find_one({"user_id": user_id}, {"searches": 1})
+    return user.get("searches", []) if user else []
+
+def add_search(db, user_id, search):
+    db["users"].update_one({"user_id": user_id}, {"$push": {"searches": search}}, upsert=True)
+    _index.add(user_id, search)
+
+# Returns False if the user has no such search
+def delete_search(db, user_id, search_id):
+    result = db["users"].update_one({"user_id": user_id}, {"$pull": {"searches": {"id": search_id}}})
+    _index.remove(user_id, search_id)
+    return result.modified_count > 0
+
+
+# Queues the alerts for a new rental. Called as rentals are created; rentals of
+# messages older than max_age_hours (e.g. from the first sync of a chat) are
+# not alerted.
+def alerts_match_rental(db, rental):
+    if not settings["enabled"] or rental.get("date") is None:
+        return 0
+    if _as_utc(rental["date"]) < datetime.now(timezone.utc) - timedelta(hours=settings["max_age_hours"]):
+        return 0
+    matches = _index.match(rental)
+    if not matches:
+        return 0
+    now = datetime.now(timezone.utc)
+    # one alert per user and rental, even when several of their searches match
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "rental_id": rental["_id"]},
+            {"$setOnInsert": {
+                "search_id": search["id"],
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+            }},
+            upsert=True,
+        )
+        for user_id, search in {user_id: search for user_id, search in matches}.items()
+    ]
+    db[ALERTS_COLLECTION].bulk_write(operations, ordered=False)
+    return len(operations)
+
+def alerts_stats(db):
+    counts = {"pending": 0, "sent": 0, "failed": 0}
+    for row in db[ALERTS_COLLECTION].aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["count"]
+    return {**counts, "searches": len(_index.searches)}
+
+
+def _format_rental(rental):
+    parts = []
+    if rental.get("price_per_month") is not None:
+        parts.append(f"{rental['price_per_month']:.0f}€/month")
+    if rental.get("room_type"):
+        parts.append(rental["room_type"])
+    if rental.get("location"):
+        parts.append(rental["location"])
+    date = rental.get("date")
+    posted = f" ({rental.get('chat_name')}, {date:%d/%m %H:%M})" if date else f" ({rental.get('chat_name')})"
+    return "• " + (", ".join(parts) or "new announcement") + posted
+
+def format_alert_message(rentals):
+    header = "New rental matching your saved searches:" if len(rentals) == 1 else \
+        f"{len(rentals)} new rentals matching your saved searches:"
+    return "\n".join([header, ""] + [_format_rental(rental) for rental in rentals])
+
+
+# Delivers the pending alerts every `interval` seconds: the alerts queued for a
+# user in the meantime are sent together in one message (up to `batch_size`
+# rentals), and at most `rate_per_minute` messages are sent per minute.
+class AlertSender:
+    def __init__(self, db, telegram, interval=60, batch_size=10, rate_per_minute=20):
+        self.db = db
+        self.telegram = telegram
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(rate_per_minute)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="alerts", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.deliver()
+            except Exception:
+                traceback.print_exc()
+
+    # Sends the pending alerts, returns how many messages were sent
+    def deliver(self):
+        by_user = {}
+        for alert in self.db[ALERTS_COLLECTION].find({"status": "pending"}).sort("created_at", ASCENDING).limit(1000):
+            by_user.setdefault(alert["user_id"], []).append(alert)
+
+        sent = 0
+        for user_id, alerts in by_user.items():
+            for i in range(0, len(alerts), self.batch_size):
+                sent += self._send(user_id, alerts[i:i + self.batch_size])
+        return sent
+
+    def _send(self, user_id, alerts):
+        rental_ids = [alert["rental_id"] for alert in alerts]
+        rentals = {rental["_id"]: rental for rental in self.db["rentals"].find({"_id": {"$in": rental_ids}})}
+        text = format_alert_message([rentals[_id] for _id in rental_ids if _id in rentals])
+        alert_ids = [alert["_id"] for alert in alerts]
+        if not rentals:
+            # rentals deleted in the meantime (e.g. re-extracted as not announcements)
+            self.db[ALERTS_COLLECTION].update_many({"_id": {"$in": alert_ids}}, {"$set": {"status": "sent"}})
+            return 0
+
+        # numeric ids are only reachable if the user wrote to the account first
+        entity = int(user_id) if user_id.lstrip("-").isdigit() else user_id
+        self.rate_limiter.acquire()
+        try:
+            self.telegram.run(lambda client: client.send_message(entity, text)).result()
+        except Exception as e:
+            print(f"Could not send alerts to {user_id}: {e}")
+            # retried at the next delivery, up to MAX_ATTEMPTS times
+            self.db[ALERTS_COLLECTION].update_many({"_id": {"$in": alert_ids}},
+                                                   {"$inc": {"attempts": 1}, "$set": {"error": str(e)}})
+            self.db[ALERTS_COLLECTION].update_many({"_id": {"$in": alert_ids}, "attempts": {"$gte": MAX_ATTEMPTS}},
+                                                   {"$set": {"status": "failed"}})
+            return 0
+        self.db[ALERTS_COLLECTION].update_many({"_id": {"$in": alert_ids}},
+                                               {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}})
+        return 1
@@ -0,0 +1,159 @@
+import gzip
+import os
+import zlib
+from datetime import datetime, timezone
+
+from bson import ObjectId, json_util
+from bson.json_util import JSONOptions, JSONMode
+from pymongo import UpdateOne
+
+# Streaming backup and restore of the database as gzipped NDJSON: one line per
+# document, {"collection": name, "doc": {...}}, in MongoDB Extended JSON so that
+# ObjectIds and dates survive the round trip. Documents are read and written
+# one batch at a time, so memory use doesn't grow with the size of the database.
+#
+# rentals is not backed up: it is rebuilt from the restored messages.
+
+BACKUP_COLLECTIONS = ["messages", "users", "sync_log", "active_chats"]
+
+# Restored documents are matched on these fields instead of _id, so that a
+# backup can be merged into a database that synced the same messages on its own
+RESTORE_KEYS = {
+    "messages": ["chat_name", "message_id"],
+}
+
+JSON_OPTIONS = JSONOptions(json_mode=JSONMode.CANONICAL, tz_aware=True, tzinfo=timezone.utc)
+
+
+# Yields the NDJSON lines (bytes) of the backup. With `since`, only the messages
+# stored or changed after that datetime are exported; the other collections are
+# small and always exported in full.
+def export_ndjson(db, collections=BACKUP_COLLECTIONS, since=None):
+    for name in collections:
+        query = {}
+        if since is not None and name == "messages":
+            query = {"$or": [
+                {"__updated_at": {"$gte": since}},
+                # stored before __updated_at existed
+                {"__updated_at": {"$exists": False}, "_id": {"$gte": ObjectId.from_datetime(since)}},
+            ]}
+        for doc in db[name].find(query, batch_size=500):
+            line = json_util.dumps({"collection": name, "doc": doc}, json_options=JSON_OPTIONS)
+            yield line.encode("utf-8") + b"\n"
+
+# Gzips a stream of chunks on the fly
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def backup_to_file(db, path, collections=BACKUP_COLLECTIONS, since=None):
+    count = 0
+    with gzip.open(path, "wb") as f:
+        for line in export_ndjson(db, collections, since):
+            f.write(line)
+            count += 1
+    return count
+
+
+def _restore_operation(name, doc):
+    fields = {k: v for k, v in doc.items() if k != "_id"}
+    key = RESTORE_KEYS.get(name)
+    if key is None:
+        update = {"$set": fields} if fields else {"$setOnInsert": {"_id": doc["_id"]}}
+        return UpdateOne({"_id": doc["_id"]}, update, upsert=True)
+    return UpdateOne(
+        {k: doc.get(k) for k in key},
+        {"$set": fields, "$setOnInsert": {"_id": doc["_id"]}},
+        upsert=True,
+    )
+
+# Restores the documents of an NDJSON backup (an iterable of lines) with
+# batched upserts, so it can be run again over the same backup, or over a
+# database that is not empty, without duplicating anything. Nothing is deleted.
+# The first `skip` lines are ignored, to resume an interrupted restore; after
+# every batch on_batch(lines_done) is called with the number of lines restored
+# so far, skipped ones included. Returns {collection: documents restored}.
+def restore_ndjson(db, lines, batch_size=500, skip=0, on_batch=None):
+    counts = {}
+    batches = {}
+    pending = 0
+    done = 0
+
+    def flush():
+        nonlocal pending
+        for name, operations in batches.items():
+            if operations:
+                db[name].bulk_write(operations, ordered=False)
+                counts[name] = counts.get(name, 0) + len(operations)
+        batches.clear()
+        pending = 0
+        if on_batch:
+            on_batch(done)
+
+    for line in lines:
+        done += 1
+        if done <= skip or not line.strip():
+            continue
+        record = json_util.loads(line, json_options=JSON_OPTIONS)
+        name = record["collection"]
+        if name not in BACKUP_COLLECTIONS:
+            raise ValueError(f"Unknown collection in backup: {name}")
+        batches.setdefault(name, []).append(_restore_operation(name, record["doc"]))
+        pending += 1
+        if pending >= batch_size:
+            flush()
+    flush()
+    return counts
+
+# Restores a backup file. Progress is saved to `<path>.progress` after every
+# batch, and a restore interrupted midway resumes from there when run again.
+def restore_from_file(db, path, batch_size=500, restart=False):
+    progress_path = path + ".progress"
+    skip = 0
+    if not restart and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            skip = int(f.read().strip() or 0)
+        print(f"Resuming from line {skip}")
+
+    def save_progress(lines_done):
+        with open(progress_path, "w") as f:
+            f.write(str(lines_done))
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        counts = restore_ndjson(db, f, batch_size, skip, save_progress)
+    os.remove(progress_path)
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    from pymongo import MongoClient
+
+    from rentals import rentals_rebuild
+
+    parser = argparse.ArgumentParser(description="Backup and restore the database as gzipped NDJSON")
+    parser.add_argument("action", choices=["backup", "restore"])
+    parser.add_argument("path", help="backup file, e.g. backup.ndjson.gz")
+    parser.add_argument("--mongo", default="mongodb://mongodb:27017")
+    parser.add_argument("--since", type=datetime.fromisoformat,
+                        help="backup only the messages stored or changed since this ISO date")
+    parser.add_argument("--collections", nargs="+", choices=BACKUP_COLLECTIONS, default=BACKUP_COLLECTIONS)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--restart", action="store_true", help="ignore the progress of an interrupted restore")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["unitn-rents"]
+    if args.action == "backup":
+        since = args.since
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        print(f"Backed up {backup_to_file(db, args.path, args.collections, since)} documents.")
+    else:
+        counts = restore_from_file(db, args.path, args.batch_size, args.restart)
+        print(f"Restored {counts}")
+        if counts.get("messages"):
+            print(f"Rebuilt {rentals_rebuild(db)} rentals.")
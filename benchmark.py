@@ -0,0 +1,359 @@
+# Offline benchmarks of the pipeline hot path, with no Ollama, Gemini or
+# Telegram: a local stand-in for the Ollama /api/chat endpoint answers with
+# the canned results of a fixture corpus of anonymized announcements
+# (data/benchmark_corpus.jsonl), after a configurable latency.
+#
+# Benchmarks:
+# - store: db_store_messages_batch, in batches like the Telegram sync
+# - pipeline: process_message over the corpus through process_messages_concurrently
+# - endpoints: the Flask API (/processed_messages, counts, /metrics)
+# each reporting throughput, p50/p99 latency and peak memory.
+#
+# Usage:
+#   python benchmark.py --repeat 20 --latency-ms 200 --output results.json
+#   python benchmark.py --baseline results.json   # exits with 1 on regressions
+#   python benchmark.py --only pipeline --token-ms 20 --chatter-tokens 40 [--no-stream]
+#   python benchmark.py --only pipeline --classify-batch-size 8
+# By default Mongo is mongomock (pip install -r requirements-dev.txt); pass e.g.
+# --mongo mongodb://localhost:27017 to use a local mongod instead, the
+# benchmark database is dropped at the end.
+import argparse
+import inspect
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import ai_pipeline
+from ai_pipeline import process_messages_concurrently
+from db_helpers import db_create_indexes, db_store_messages_batch
+from llm_client import llm_client_init
+from prefilter import prefilter_init
+from rentals import rentals_create_indexes, rentals_rebuild
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "benchmark_corpus.jsonl")
+BENCHMARK_DB = "unitn-rents-benchmark"
+
+ENDPOINTS = [
+    "/processed_messages?sort=date-desc&limit=24",
+    "/processed_messages?sort=price-asc&max_price=400&room_type=single&limit=24",
+    "/messages/count/processed",
+    "/metrics",
+]
+
+
+# Corpus entries: {"text", "label": YES/NO/MALFORMED, "features": {...} or null}
+# mongomock 4.3 predates the sort option that pymongo 4.11 passes to the bulk
+# updates and replaces: drop it when unused, so that bulk_write works with the
+# pymongo of requirements.txt
+def mongomock_client():
+    import mongomock
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ("add_update", "add_replace"):
+        method = getattr(builder, name)
+        if "sort" in inspect.signature(method).parameters:
+            continue
+
+        def without_sort(self, *args, _method=method, sort=None, **kwargs):
+            if sort is not None:
+                raise NotImplementedError("mongomock doesn't support sort in bulk writes")
+            return _method(self, *args, **kwargs)
+        setattr(builder, name, without_sort)
+    return mongomock.MongoClient()
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+CHATTER = " Let me know if you need anything else {for example, the other listings}."
+
+# Answers like Ollama, with the canned result of the corpus message found in
+# the prompt (of each numbered message, for batched classifications). The first token comes after latency_ms +- jitter_ms, then one
+# token every token_ms; chatter_tokens tokens of chatter follow the answer, like
+# models that don't stop at the end of the JSON. Streams when asked to.
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    corpus = []
+    latency_ms = 0
+    jitter_ms = 0
+    token_ms = 0
+    chatter_tokens = 0
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not payload.get("messages"):
+            # preload
+            self._send_json({"model": payload.get("model"), "message": {"role": "assistant", "content": ""}, "done": True})
+            return
+        prompt = "\n".join(message["content"] for message in payload["messages"])
+        entry = next((e for e in self.corpus if e["text"] in prompt), {"label": "NO", "features": None})
+
+        if payload.get("format"):
+            answer = json.dumps({"classification": entry["label"], "features": entry["features"]})
+        elif "one line per message" in prompt:
+            items = re.split(r"^\[\d+\]$", payload["messages"][-1]["content"], flags=re.MULTILINE)[1:]
+            answer = "\n".join(f"{i}: {self._label(item)}" for i, item in enumerate(items, 1))
+        elif 'Respond only with "YES"' in prompt:
+            answer = "MALFORMED, no price detected." if entry["label"] == "MALFORMED" else entry["label"]
+        else:
+            answer = json.dumps(entry["features"] or ai_pipeline.empty_features([]))
+
+        # roughly 4 characters per token
+        tokens = [answer[i:i + 4] for i in range(0, len(answer), 4)]
+        chatter = (CHATTER * (self.chatter_tokens // 10 + 1))
+        tokens += [chatter[i * 4:i * 4 + 4] for i in range(self.chatter_tokens)]
+        counts = {"prompt_eval_count": len(prompt) // 4, "eval_count": len(tokens)}
+
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(delay, 0) / 1000)
+
+        if not payload.get("stream"):
+            time.sleep(self.token_ms * len(tokens) / 1000)
+            self._send_json({"model": payload.get("model"), "message": self._message("".join(tokens)), "done": True, **counts})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(self.token_ms / 1000)
+                self.wfile.write(json.dumps({"message": self._message(token), "done": False}).encode() + b"\n")
+                self.wfile.flush()
+            self.wfile.write(json.dumps({"message": self._message(""), "done": True, **counts}).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading early
+            pass
+
+    def _label(self, text):
+        entry = next((e for e in self.corpus if e["text"] == text.strip()), {"label": "NO"})
+        return "MALFORMED, no price detected." if entry["label"] == "MALFORMED" else entry["label"]
+
+    @staticmethod
+    def _message(content):
+        return {"role": "assistant", "content": content}
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Starts the mock server on a free port, returns the server and its URL
+def start_mock_ollama(corpus, latency_ms=0, jitter_ms=0, token_ms=0, chatter_tokens=0):
+    handler = type("Handler", (MockOllamaHandler,), {
+        "corpus": corpus, "latency_ms": latency_ms, "jitter_ms": jitter_ms,
+        "token_ms": token_ms, "chatter_tokens": chatter_tokens,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-ollama", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/chat"
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+# Runs fn(), which returns (items, latencies in seconds), and summarizes it
+def measure(fn, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    items, latencies = fn()
+    elapsed = time.perf_counter() - start
+    result = {
+        "items": items,
+        "seconds": elapsed,
+        "throughput": items / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0,
+        # high-water mark of the whole process
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if trace_memory:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return result
+
+
+# Stores the corpus `repeat` times, as Telethon-like messages
+def bench_store(db, corpus, repeat, batch_size=200):
+    date = datetime.now(timezone.utc) - timedelta(days=30)
+    messages = [
+        SimpleNamespace(id=i + 1, date=date + timedelta(minutes=i), message=entry["text"])
+        for i, entry in enumerate(corpus * repeat)
+    ]
+
+    def run():
+        latencies = []
+        for i in range(0, len(messages), batch_size):
+            start = time.perf_counter()
+            db_store_messages_batch(db, "benchmark", messages[i:i + batch_size])
+            latencies.append(time.perf_counter() - start)
+        return len(messages), latencies
+
+    return run
+
+# Processes the corpus `repeat` times. Latency is per message, from when it is
+# handed to the worker pool to its result. With use_db, the pre-filter stats
+# and the LLM cache are used (repeated messages then hit the cache).
+def bench_pipeline(db, corpus, repeat, concurrency, mode, use_db=False):
+    def run():
+        latencies = []
+        started = {}
+
+        def messages():
+            for i, entry in enumerate(corpus * repeat):
+                started[i] = time.perf_counter()
+                yield {"_id": i, "text": entry["text"]}
+
+        def on_result(msg, result):
+            latencies.append(time.perf_counter() - started.pop(msg["_id"]))
+
+        def on_error(msg, error):
+            started.pop(msg["_id"], None)
+
+        process_messages_concurrently(db if use_db else None, messages(), on_result, on_error,
+                                      model="ollama", concurrency=concurrency, mode=mode)
+        return len(latencies), latencies
+
+    return run
+
+# Calls each endpoint `repeat` times through the Flask test client
+def bench_endpoints(client, repeat):
+    def run():
+        latencies = []
+        for _ in range(repeat):
+            for url in ENDPOINTS:
+                start = time.perf_counter()
+                response = client.get(url)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url}: {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return len(latencies), latencies
+
+    return run
+
+# Gives the stored messages the canned features of the corpus, and builds the
+# rentals the endpoints read
+def load_processed_messages(db, corpus):
+    for entry in corpus:
+        db["messages"].update_many(
+            {"text": entry["text"]},
+            {"$set": {"__processed": True, "extracted_features": entry["features"]}},
+        )
+    rentals_rebuild(db)
+
+
+# Regressions of `results` against `baseline`: throughput down, or p99 latency
+# up, by more than `tolerance`
+def compare(results, baseline, tolerance=0.2):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']:.1f}/s, was {base['throughput']:.1f}/s")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.1f}ms, was {base['p99_ms']:.1f}ms")
+    return regressions
+
+def print_results(results):
+    print(f"\n{'benchmark':<12}{'items':>8}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'rss MB':>10}{'traced MB':>11}")
+    for name, r in results.items():
+        traced = f"{r['peak_traced_mb']:.1f}" if "peak_traced_mb" in r else "-"
+        print(f"{name:<12}{r['items']:>8}{r['throughput']:>12.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['peak_rss_mb']:>10.1f}{traced:>11}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the pipeline hot path")
+    parser.add_argument("--mongo", default="mongomock", help="'mongomock' or a MongoDB URL")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--repeat", type=int, default=10, help="times the corpus is repeated")
+    parser.add_argument("--latency-ms", type=float, default=50, help="mock LLM latency to the first token")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--token-ms", type=float, default=0, help="mock LLM time per generated token")
+    parser.add_argument("--chatter-tokens", type=int, default=0, help="tokens the mock LLM generates after the answer")
+    parser.add_argument("--no-stream", action="store_true", help="wait for the full LLM responses")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mode", default="two_stage", choices=ai_pipeline.PIPELINE_MODES)
+    parser.add_argument("--classify-batch-size", type=int, default=1, help="messages classified per LLM call")
+    parser.add_argument("--with-db", action="store_true", help="use the pre-filter stats and the LLM cache in the pipeline")
+    parser.add_argument("--no-prefilter", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the peak Python allocations (slower)")
+    parser.add_argument("--only", nargs="+", choices=["store", "pipeline", "endpoints"])
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results saved in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    args = parser.parse_args()
+
+    if args.mongo == "mongomock":
+        mongo_client = mongomock_client()
+    else:
+        from pymongo import MongoClient
+        mongo_client = MongoClient(args.mongo)
+    mongo_client.drop_database(BENCHMARK_DB)
+    db = mongo_client[BENCHMARK_DB]
+    db_create_indexes(db)
+    rentals_create_indexes(db)
+
+    corpus = load_corpus(args.corpus)
+    server, ai_pipeline.OLLAMA_URL = start_mock_ollama(corpus, args.latency_ms, args.jitter_ms,
+                                                       args.token_ms, args.chatter_tokens)
+    llm_client_init({})
+    ai_pipeline.pipeline_init(stream=not args.no_stream, classify_batch_size=args.classify_batch_size)
+    prefilter_init(enabled=not args.no_prefilter)
+
+    only = args.only or ["store", "pipeline", "endpoints"]
+    results = {}
+    try:
+        if "store" in only or "endpoints" in only:
+            results["store"] = measure(bench_store(db, corpus, args.repeat), args.trace_memory)
+        if "pipeline" in only:
+            results["pipeline"] = measure(bench_pipeline(db, corpus, args.repeat, args.concurrency,
+                                                         args.mode, args.with_db), args.trace_memory)
+        if "endpoints" in only:
+            from init import init_app
+
+            load_processed_messages(db, corpus)
+            app = init_app(config={"telegram": {"api_id": 0, "app_hash": ""}, "gemini": None,
+                                   "pipeline": {"stream": not args.no_stream}},
+                           mongo_client=mongo_client, db_name=BENCHMARK_DB)
+            results["endpoints"] = measure(bench_endpoints(app.test_client(), args.repeat), args.trace_memory)
+    finally:
+        server.shutdown()
+        mongo_client.drop_database(BENCHMARK_DB)
+
+    results = {name: results[name] for name in only if name in results}
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions.")
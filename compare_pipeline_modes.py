@@ -0,0 +1,111 @@
+# Compares the two_stage and single_pass pipeline modes on a sample of the
+# synced messages: LLM calls, tokens and latency per message, and how often
+# single_pass agrees with two_stage on classification and on each feature.
+#
+# Usage (from the app container):
+#   python compare_pipeline_modes.py --limit 50 --model ollama
+import argparse
+import statistics
+import time
+
+import yaml
+from pymongo import MongoClient
+
+from ai_pipeline import process_message, reset_usage, get_usage, FEATURES_SCHEMA
+from prefilter import prefilter_init
+
+
+def run_mode(messages, mode, model, gemini_key):
+    runs = []
+    for msg in messages:
+        reset_usage()
+        start = time.perf_counter()
+        try:
+            res = process_message(None, msg, model=model, gemini_key=gemini_key, mode=mode)
+            features = res["extracted_features"]
+            error = None
+        except Exception as e:
+            features = None
+            error = str(e)
+        runs.append({
+            "latency": time.perf_counter() - start,
+            "features": features,
+            "error": error,
+            **get_usage(),
+        })
+        print(f"[{mode}] {len(runs)}/{len(messages)} - {runs[-1]['latency']:.2f}s")
+    return runs
+
+def summarize(runs):
+    latencies = sorted(r["latency"] for r in runs)
+    return {
+        "messages": len(runs),
+        "errors": sum(1 for r in runs if r["error"]),
+        "positives": sum(1 for r in runs if r["features"] is not None),
+        "llm_calls": sum(r["calls"] for r in runs),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in runs),
+        "completion_tokens": sum(r["completion_tokens"] for r in runs),
+        "total_time": sum(latencies),
+        "mean_latency": statistics.mean(latencies) if latencies else 0,
+        "p50_latency": latencies[len(latencies) // 2] if latencies else 0,
+        "p99_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0,
+    }
+
+# Agreement of single_pass with two_stage, which is used as the reference
+def agreement(reference_runs, runs):
+    classification_matches = 0
+    field_matches = {field: 0 for field in FEATURES_SCHEMA["properties"]}
+    both_positive = 0
+
+    for ref, run in zip(reference_runs, runs):
+        if (ref["features"] is None) == (run["features"] is None):
+            classification_matches += 1
+        if ref["features"] is None or run["features"] is None:
+            continue
+        both_positive += 1
+        for field in field_matches:
+            a, b = ref["features"].get(field), run["features"].get(field)
+            if isinstance(a, list) and isinstance(b, list):
+                a, b = sorted(map(str, a)), sorted(map(str, b))
+            if a == b:
+                field_matches[field] += 1
+
+    return {
+        "classification": classification_matches / len(runs) if runs else None,
+        "fields": {field: count / both_positive for field, count in field_matches.items()} if both_positive else {},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the two_stage and single_pass pipeline modes")
+    parser.add_argument("--limit", type=int, default=50, help="number of messages to sample")
+    parser.add_argument("--model", default="ollama", choices=["ollama", "gemini"])
+    parser.add_argument("--mongo", default="mongodb://mongodb:27017")
+    args = parser.parse_args()
+
+    with open("config.yaml", "r") as f:
+        config = yaml.safe_load(f)
+    gemini_key = (config.get("gemini") or {}).get("api_key")
+
+    # every message goes through the LLM, in both modes
+    prefilter_init(enabled=False)
+
+    db = MongoClient(args.mongo)["unitn-rents"]
+    messages = list(db["messages"].aggregate([
+        {"$match": {"text": {"$nin": [None, ""]}}},
+        {"$sample": {"size": args.limit}},
+    ]))
+
+    two_stage = run_mode(messages, "two_stage", args.model, gemini_key)
+    single_pass = run_mode(messages, "single_pass", args.model, gemini_key)
+
+    for name, runs in [("two_stage", two_stage), ("single_pass", single_pass)]:
+        print(f"\n{name}:")
+        for key, value in summarize(runs).items():
+            print(f"  {key}: {value:.3f}" if isinstance(value, float) else f"  {key}: {value}")
+
+    result = agreement(two_stage, single_pass)
+    print("\nsingle_pass agreement with two_stage:")
+    print(f"  classification: {result['classification']:.1%}")
+    for field, rate in result["fields"].items():
+        print(f"  {field}: {rate:.1%}")
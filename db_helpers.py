@@ -1,4 +1,36 @@
-from datetime import datetime
+import base64
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure
+
+from rentals import rental_sync_message
+from alerts import alerts_match_rental
+from stats import stats_inc
+from geocoding import distance_km, EARTH_RADIUS_KM
+
+
+# Creates the indexes used by the app. Safe to call at every startup.
+def db_create_indexes(db):
+    try:
+        db["messages"].create_index(
+            [("chat_name", ASCENDING), ("message_id", DESCENDING)],
+            unique=True,
+            name="chat_message_unique",
+        )
+    except OperationFailure as e:
+        # e.g. duplicated messages stored before the index existed
+        print(f"Could not create the unique messages index: {e}")
+    db["messages"].create_index("__processed")
+    db["messages"].create_index("extracted_features", sparse=True)
+    # incremental backups
+    db["messages"].create_index("__updated_at")
+    # re-extraction of the stale messages, newest first
+    db["messages"].create_index([("__processed", ASCENDING), ("date", DESCENDING)])
 
 
 def db_get_last_message_id(db, chat_name):
@@ -6,24 +38,150 @@ def db_get_last_message_id(db, chat_name):
     last_message = list(last_message)
     return last_message[0]["message_id"] if last_message else None
 
+# Stores the messages with a single unordered bulk upsert. Telegram message ids
+# are only unique within a chat, so messages are identified by (chat_name, message_id).
+# Returns the number of new messages.
 def db_store_messages_batch(db, chat_name, messages):
-    docs = []
+    now = datetime.now(timezone.utc)
+    operations = []
     for msg in messages:
-        # Check for duplicates
-        if db["messages"].find_one({"message_id": msg.id}):
-            continue
-        docs.append({
-            "chat_name": chat_name,
-            "message_id": msg.id,
-            "date": msg.date,
-            "text": msg.message,
-        })
+        operations.append(UpdateOne(
+            {"chat_name": chat_name, "message_id": msg.id},
+            {"$setOnInsert": {
+                "chat_name": chat_name,
+                "message_id": msg.id,
+                "date": msg.date,
+                "text": msg.message,
+                "__updated_at": now,
+            }},
+            upsert=True,
+        ))
+
+    if not operations:
+        return 0
+    result = db["messages"].bulk_write(operations, ordered=False)
+    stats_inc(db, messages=result.upserted_count)
+    return result.upserted_count
 
-    if docs:
-        db["messages"].insert_many(docs)
-    return len(docs)
+# Stores the new text of an edited message and marks it for processing again.
+# The old extracted features are kept until the new ones are ready; the lease is
+# dropped so that a result computed on the old text is discarded.
+def db_store_edited_message(db, chat_name, msg):
+    old = db["messages"].find_one_and_update(
+        {"chat_name": chat_name, "message_id": msg.id},
+        {
+            "$set": {
+                "chat_name": chat_name,
+                "message_id": msg.id,
+                "date": msg.date,
+                "edit_date": msg.edit_date,
+                "text": msg.message,
+                "__processed": False,
+                "__updated_at": datetime.now(timezone.utc),
+            },
+            "$unset": {"__lease_owner": "", "__lease_until": ""},
+        },
+        projection={"__processed": 1},
+        upsert=True,
+    )
+    if old is None:
+        stats_inc(db, messages=1)
+    elif old.get("__processed"):
+        stats_inc(db, processed=-1)
+
+# Atomically claims one unprocessed message of the given chats, so that several
+# pipeline workers (threads or processes) never process the same message twice.
+# The claim is a lease: if the worker dies, the message becomes claimable again
+# once `lease_seconds` have passed.
+def db_claim_unprocessed_message(db, chat_names, worker_id, lease_seconds=600):
+    return _db_claim(db, {"chat_name": {"$in": chat_names}, "__processed": {"$ne": True}}, worker_id, lease_seconds)
+
+# Same as db_claim_unprocessed_message, for one specific message. Returns None
+# if it is already processed or claimed by another worker.
+def db_claim_message(db, chat_name, message_id, worker_id, lease_seconds=600):
+    return _db_claim(db, {"chat_name": chat_name, "message_id": message_id, "__processed": {"$ne": True}},
+                     worker_id, lease_seconds)
+
+# Claims the newest processed message whose features were extracted with
+# another model or prompt version than `processed_with`. The message stays
+# processed, with its old features, until the new ones are stored.
+def db_claim_stale_message(db, processed_with, worker_id, lease_seconds=600):
+    return _db_claim(db, _stale_query(processed_with), worker_id, lease_seconds, sort=[("date", DESCENDING)])
 
+# processed_with: {"model": model name, "prompt_version": prompt version}
+def _stale_query(processed_with):
+    return {"__processed": True, "__processed_with": {"$ne": processed_with}}
 
+def db_count_stale_messages(db, processed_with):
+    return db["messages"].count_documents(_stale_query(processed_with))
+
+# The newest stale messages, without claiming them
+def db_get_stale_messages(db, processed_with, limit):
+    return db["messages"].find(_stale_query(processed_with)).sort("date", DESCENDING).limit(limit)
+
+def _db_claim(db, query, worker_id, lease_seconds, sort=None):
+    now = datetime.now(timezone.utc)
+    return db["messages"].find_one_and_update(
+        {
+            **query,
+            "$or": [
+                {"__lease_until": None},
+                {"__lease_until": {"$lt": now}},
+            ],
+        },
+        {"$set": {
+            "__lease_owner": worker_id,
+            "__lease_until": now + timedelta(seconds=lease_seconds),
+        }},
+        sort=sort,
+    )
+
+# Yields claimed messages until there is nothing left to claim, or until
+# should_stop() returns True. Messages are claimed lazily, one at a time, as the
+# consumer asks for them.
+def db_iter_claimed_messages(db, chat_names, worker_id, lease_seconds=600, should_stop=None):
+    while not (should_stop and should_stop()):
+        message = db_claim_unprocessed_message(db, chat_names, worker_id, lease_seconds)
+        if message is None:
+            return
+        yield message
+
+# Same as db_iter_claimed_messages, for the stale messages, newest first
+def db_iter_stale_messages(db, processed_with, worker_id, lease_seconds=600, should_stop=None):
+    while not (should_stop and should_stop()):
+        message = db_claim_stale_message(db, processed_with, worker_id, lease_seconds)
+        if message is None:
+            return
+        yield message
+
+# Marks a claimed message as processed, and updates its rental. Does nothing if
+# the lease was lost to another worker in the meantime. processed_with records
+# the model and prompt version the features come from, decided_by whether the
+# pre-filter or the LLM classified the message.
+def db_complete_claimed_message(db, _id, worker_id, extracted_features, processed_with=None, decided_by=None):
+    fields = {
+        "__processed": True,
+        "extracted_features": extracted_features,
+        "__processed_with": processed_with,
+        "__decided_by": decided_by,
+        "__updated_at": datetime.now(timezone.utc),
+    }
+    # the document before the update tells whether it was processed already
+    old = db["messages"].find_one_and_update(
+        {"_id": _id, "__lease_owner": worker_id},
+        {"$set": fields, "$unset": {"__lease_owner": "", "__lease_until": ""}},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if old is None:
+        return False
+    if not old.get("__processed"):
+        stats_inc(db, processed=1)
+    message = {**old, **fields}
+    rental, created = rental_sync_message(db, message)
+    # only messages processed for the first time: not re-extractions
+    if created and not old.get("__processed"):
+        alerts_match_rental(db, rental)
+    return True
 
 def db_get_unprocessed_messages(db):
     unprocessed_messages = db["messages"].find({"processed": {"$ne": True}})
@@ -83,6 +241,20 @@ def db_update_last_date_check(db, chat_name, date):
         upsert=True
     )
 
+# Id of the last message downloaded by the history sync of a chat. Only the sync
+# moves it: the live listener stores newer messages too, which must not make the
+# sync skip the ones before them.
+def db_get_sync_watermark(db, chat_name):
+    sync_log = db["sync_log"].find_one({"chat_name": chat_name})
+    return sync_log.get("last_synced_id") if sync_log else None
+
+def db_update_sync_watermark(db, chat_name, message_id):
+    db["sync_log"].update_one(
+        {"chat_name": chat_name},
+        {"$max": {"last_synced_id": message_id}},
+        upsert=True
+    )
+
 def db_delete_message(db, message_id):
     db["messages"].delete_one({"message_id": message_id})
 
@@ -103,22 +275,6 @@ def db_delete_all_data(db):
     db_delete_all_users(db)
     db_delete_all_sync_logs(db)
 
-def db_get_all_data(db):
-    return {
-        "messages": db_get_all_messages(db),
-        "users": db_get_all_users(db),
-        "sync_log": list(db["sync_log"].find({}))
-    }
-
-def db_restore_data(db, data):
-    db_delete_all_data(db)
-    if "messages" in data and data["messages"]:
-        db["messages"].insert_many(data["messages"])
-    if "users" in data and data["users"]:
-        db["users"].insert_many(data["users"])
-    if "sync_log" in data and data["sync_log"]:
-        db["sync_log"].insert_many(data["sync_log"])
-
 def db_get_stats(db):
     return {
         "messages": db["messages"].count_documents({}),
@@ -127,32 +283,198 @@ def db_get_stats(db):
     }
     
 def db_get_processed_rentals_with_features(db):
-    rentals = db["messages"].find({
-        "processed": True, 
-        "extracted_features": {"$ne": None}
-    })
+    rentals = db["rentals"].find({})
     
     formatted_rentals = []
     for rental in rentals:
-        features = rental.get("extracted_features", {})
-        price = features.get("price_per_month")
-        if price is None or price == 0:
+        price = rental["price_per_month"]
+        if price is None:
             price = -1
             
         formatted_rentals.append({
             "message_id": rental["message_id"],
             "date": rental["date"].isoformat(),
-            "text": rental["text"],
             "price_per_month": price,
-            "room_type": features.get("room_type"),
-            "location": features.get("location"),
-            "target_gender": features.get("target_gender"),
-            "target_audience": features.get("target_audience"),
-            "available_from": features.get("available_from"),
-            "contract_duration": features.get("contract_duration"),
-            "utilities_included": features.get("utilities_included"),
-            "amenities": features.get("amenities"),
-            "other": features.get("other")
+            "room_type": rental["room_type"],
+            "location": rental["location"],
+            "target_gender": rental["target_gender"],
+            "target_audience": rental["target_audience"],
+            "available_from": rental["available_from_text"],
+            "contract_duration": rental["contract_duration"],
+            "utilities_included": rental["utilities_included"],
+            "amenities": rental["amenities"],
+            "other": rental["other"]
         })
         
-    return formatted_rentals
\ No newline at end of file
+    return formatted_rentals
+
+
+# Sort options of db_query_processed_messages: (field, direction)
+PROCESSED_MESSAGES_SORTS = {
+    "price-asc": ("price_per_month", ASCENDING),
+    "price-desc": ("price_per_month", DESCENDING),
+    "date-asc": ("date", ASCENDING),
+    "date-desc": ("date", DESCENDING),
+    # nearest first, requires the "near" filter
+    "distance": ("distance", ASCENDING),
+}
+
+PROCESSED_MESSAGES_PROJECTION = {
+    "date": 1,
+    "chat_name": 1,
+    "price_per_month": 1,
+    "room_type": 1,
+    "location": 1,
+    "target_gender": 1,
+    "target_audience": 1,
+    "available_from": 1,
+    "available_from_text": 1,
+    "contract_duration": 1,
+    "utilities_included": 1,
+    "amenities": 1,
+    "other": 1,
+    "location_match": 1,
+    "location_point": 1,
+}
+
+# Builds the query on the rentals collection of db_query_processed_messages
+# from the filters: min_price, max_price, room_type, target_gender,
+# utilities_included, amenities (all required), location (substring),
+# date_from, date_to, near ((lat, lon)) and max_distance_km
+def _processed_messages_query(filters):
+    query = {}
+
+    price = {}
+    if filters.get("min_price") is not None:
+        price["$gte"] = filters["min_price"]
+    if filters.get("max_price") is not None:
+        price["$lte"] = filters["max_price"]
+    if price:
+        query["price_per_month"] = price
+    if filters.get("room_type"):
+        query["room_type"] = filters["room_type"]
+    if filters.get("target_gender") and filters["target_gender"] != "any":
+        query["target_gender"] = {"$in": [filters["target_gender"], "any"]}
+    if filters.get("utilities_included") is not None:
+        query["utilities_included"] = filters["utilities_included"]
+    if filters.get("amenities"):
+        query["amenities"] = {"$all": filters["amenities"]}
+    if filters.get("location"):
+        query["location"] = {"$regex": re.escape(filters["location"]), "$options": "i"}
+
+    date = {}
+    if filters.get("date_from"):
+        date["$gte"] = filters["date_from"]
+    if filters.get("date_to"):
+        date["$lte"] = filters["date_to"]
+    if date:
+        query["date"] = date
+
+    if filters.get("near") and filters.get("max_distance_km") is not None:
+        lat, lon = filters["near"]
+        query["location_point"] = {"$geoWithin": {
+            "$centerSphere": [[lon, lat], filters["max_distance_km"] / EARTH_RADIUS_KM],
+        }}
+    return query
+
+def _encode_cursor(value, _id):
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([value, str(_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        value, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(value, dict) and "$date" in value:
+            value = datetime.fromisoformat(value["$date"])
+        return value, ObjectId(_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# Returns a page of rentals matching the filters (see _processed_messages_query),
+# as (items, total, next_cursor). Pages are keyset-paginated on (sort field, _id):
+# pass the returned next_cursor to get the following page, it is None on the last one.
+def db_query_processed_messages(db, filters, sort="date-desc", limit=24, cursor=None):
+    field, direction = PROCESSED_MESSAGES_SORTS[sort]
+    query = _processed_messages_query(filters)
+    if field == "distance":
+        return _query_rentals_by_distance(db, filters, query, limit, cursor)
+    if field == "price_per_month":
+        # announcements without a price can't be sorted by price
+        query[field] = {**query.get(field, {}), "$ne": None}
+
+    total = db["rentals"].count_documents(query)
+
+    page_query = query
+    if cursor:
+        value, _id = _decode_cursor(cursor)
+        op = "$gt" if direction == ASCENDING else "$lt"
+        page_query = {"$and": [query, {"$or": [
+            {field: {op: value}},
+            {field: value, "_id": {op: _id}},
+        ]}]}
+
+    docs = list(db["rentals"]
+                .find(page_query, PROCESSED_MESSAGES_PROJECTION)
+                .sort([(field, direction), ("_id", direction)])
+                .limit(limit + 1))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = _encode_cursor(docs[-1][field], docs[-1]["_id"])
+
+    for doc in docs:
+        doc["id"] = str(doc.pop("_id"))
+        if filters.get("near") and doc.get("location_point"):
+            lon, lat = doc["location_point"]["coordinates"]
+            doc["distance_km"] = distance_km(*filters["near"], lat, lon)
+    return docs, total, next_cursor
+
+# Nearest first with $geoNear. Distances are not unique keys, so the cursor of
+# these pages is an offset: fine for the few rentals around a campus.
+def _query_rentals_by_distance(db, filters, query, limit, cursor):
+    if not filters.get("near"):
+        raise ValueError("Sorting by distance requires the 'near' parameter")
+    lat, lon = filters["near"]
+    geo_query = {key: value for key, value in query.items() if key != "location_point"}
+
+    geo_near = {
+        "near": {"type": "Point", "coordinates": [lon, lat]},
+        "distanceField": "distance",
+        "spherical": True,
+        "query": geo_query,
+    }
+    if filters.get("max_distance_km") is not None:
+        geo_near["maxDistance"] = filters["max_distance_km"] * 1000
+
+    count_query = query if "location_point" in query else {**query, "location_point": {"$exists": True}}
+    total = db["rentals"].count_documents(count_query)
+    offset = _decode_cursor(cursor)[0] if cursor else 0
+
+    docs = list(db["rentals"].aggregate([
+        {"$geoNear": geo_near},
+        {"$skip": offset},
+        {"$limit": limit + 1},
+        {"$project": {**PROCESSED_MESSAGES_PROJECTION, "distance": 1}},
+    ]))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = _encode_cursor(offset + limit, docs[-1]["_id"])
+
+    for doc in docs:
+        doc["id"] = str(doc.pop("_id"))
+        doc["distance_km"] = doc.pop("distance") / 1000
+    return docs, total, next_cursor
+
+# Highest price among the rentals, or None
+def db_get_max_price(db):
+    doc = db["rentals"].find_one(
+        {"price_per_month": {"$ne": None}},
+        {"price_per_month": 1},
+        sort=[("price_per_month", DESCENDING)],
+    )
+    return doc["price_per_month"] if doc else None
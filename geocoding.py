@@ -0,0 +1,136 @@
+import csv
+import math
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+# Offline geocoding of the free-text rental locations ("via Matteotti", "Povo")
+# against a local gazetteer of Trento streets, areas and landmarks.
+#
+# The gazetteer is data/trento_gazetteer.csv (name, aliases separated by "|",
+# lat, lon, kind). The bundled one has approximate coordinates of the streets
+# and areas that come up the most; it can be extended with the streets of an
+# OpenStreetMap export with `python geocoding.py --import-overpass streets.json`.
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "trento_gazetteer.csv")
+
+CAMPUSES = {
+    "povo": {"name": "Povo (Polo Ferrari)", "lat": 46.0670, "lon": 11.1505},
+    "mesiano": {"name": "Mesiano (Ingegneria)", "lat": 46.0647, "lon": 11.1397},
+    "centro": {"name": "Centro (Via Verdi)", "lat": 46.0665, "lon": 11.1183},
+}
+
+EARTH_RADIUS_KM = 6371.0
+
+_gazetteer = None
+
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def load_gazetteer(path=GAZETTEER_PATH):
+    entries = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            aliases = {_normalize(alias) for alias in row["aliases"].split("|") if alias.strip()}
+            aliases.add(_normalize(row["name"]))
+            entries.append({
+                "name": row["name"],
+                "aliases": sorted(aliases, key=len, reverse=True),
+                "lat": float(row["lat"]),
+                "lon": float(row["lon"]),
+                "kind": row["kind"],
+            })
+    return entries
+
+def _get_gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = load_gazetteer()
+    return _gazetteer
+
+# Returns {"name", "kind", "point"} (point is a GeoJSON Point) for the gazetteer
+# entry matching the location text, or None. The longest matching alias wins,
+# so "via Matteotti, zona centro" resolves to the street, not to the area.
+# Street names repeat a lot across announcements, hence the cache.
+@lru_cache(maxsize=4096)
+def geocode(location):
+    if not location:
+        return None
+    text = f" {_normalize(location)} "
+
+    best = None
+    best_length = 0
+    for entry in _get_gazetteer():
+        for alias in entry["aliases"]:
+            if len(alias) > best_length and f" {alias} " in text:
+                best = entry
+                best_length = len(alias)
+                break
+    if best is None:
+        return None
+    return {
+        "name": best["name"],
+        "kind": best["kind"],
+        "point": {"type": "Point", "coordinates": [best["lon"], best["lat"]]},
+    }
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# Parses a campus key ("povo") or "lat,lon" into (lat, lon)
+def parse_place(value):
+    if value in CAMPUSES:
+        return CAMPUSES[value]["lat"], CAMPUSES[value]["lon"]
+    try:
+        lat, lon = (float(x) for x in value.split(","))
+    except ValueError:
+        raise ValueError(f"Invalid place: {value}, use one of {', '.join(CAMPUSES)} or 'lat,lon'")
+    return lat, lon
+
+# Adds the named streets of an Overpass API export to the gazetteer, e.g. of:
+#   [out:json]; area[name="Trento"][admin_level=8]->.a;
+#   way(area.a)[highway][name]; out center;
+def import_overpass(json_path, path=GAZETTEER_PATH):
+    import json
+
+    with open(json_path, encoding="utf-8") as f:
+        elements = json.load(f)["elements"]
+
+    known = {_normalize(entry["name"]) for entry in load_gazetteer(path)}
+    points = {}
+    for element in elements:
+        name = element.get("tags", {}).get("name")
+        center = element.get("center") or ({"lat": element["lat"], "lon": element["lon"]} if "lat" in element else None)
+        if not name or not center or _normalize(name) in known:
+            continue
+        # a street is made of many ways: average their centers
+        points.setdefault(name, []).append((center["lat"], center["lon"]))
+
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        for name, coords in sorted(points.items()):
+            lat = sum(c[0] for c in coords) / len(coords)
+            lon = sum(c[1] for c in coords) / len(coords)
+            writer.writerow([name, name.lower(), f"{lat:.5f}", f"{lon:.5f}", "street"])
+    return len(points)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Trento gazetteer tools")
+    parser.add_argument("--import-overpass", metavar="JSON", help="add the streets of an Overpass API export")
+    parser.add_argument("--lookup", metavar="LOCATION", help="geocode a location")
+    args = parser.parse_args()
+
+    if args.import_overpass:
+        print(f"Added {import_overpass(args.import_overpass)} streets.")
+    if args.lookup:
+        print(geocode(args.lookup))
@@ -1,32 +1,144 @@
+import os
+import atexit
+import json
+import socket
+import uuid
+import threading
+import gzip
 import yaml
 import time
+from datetime import datetime, timezone
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
-from telethon import TelegramClient
+from a2wsgi import WSGIMiddleware
 
-from ai_pipeline import process_message
-from db_helpers import db_store_messages_batch, db_get_last_message_id
+from alerts import alerts_init, alerts_reload, alerts_stats, parse_search, get_searches, add_search, delete_search, AlertSender
+from backup import export_ndjson, gzip_chunks, restore_ndjson, BACKUP_COLLECTIONS
+from geocoding import parse_place, CAMPUSES
+from rentals import rentals_create_indexes, rentals_rebuild
+from telegram_sync import TelegramService, sync_active_chats
+from telegram_listener import TelegramListener, LivePipelineWorker
+from jobs import JobRunner, ACTIVE_STATUSES
+from llm_client import llm_client_init
+from metrics import render_metrics, QUEUE_DEPTH
+from prefilter import prefilter_init, prefilter_stats
+from llm_cache import llm_cache_init, cache_stats
+from ai_pipeline import (
+    process_message,
+    process_messages_concurrently,
+    pipeline_init,
+    ollama_preload,
+    get_processed_with,
+    is_failed_result,
+    PIPELINE_MODES,
+)
+from reextract import reextract_diff_report
+from search import search_create_indexes, search_messages
+from stats import stats_create_indexes, stats_rebuild, stats_exist, stats_get, stats_counts
+from db_helpers import (
+    db_create_indexes,
+    db_iter_claimed_messages,
+    db_claim_message,
+    db_query_processed_messages,
+    db_get_max_price,
+    PROCESSED_MESSAGES_SORTS,
+    db_complete_claimed_message,
+    db_iter_stale_messages,
+    db_count_stale_messages,
+)
 
-def init_app():
+# config and mongo_client default to config.yaml and the docker compose mongodb;
+# the benchmarks pass their own
+def init_app(config=None, mongo_client=None, db_name="unitn-rents"):
     app = Flask(__name__)
     CORS(app)
 
     # Init config
-    with open("config.yaml", "r") as f:
-        config = yaml.safe_load(f)
+    if config is None:
+        with open("config.yaml", "r") as f:
+            config = yaml.safe_load(f)
     app.config["telegram"] = config["telegram"]
     app.config["gemini"] = config["gemini"]
+    app.config["sync"] = config.get("sync", {})
+    app.config["sync"].setdefault("batch_size", 200)
+    app.config["sync"].setdefault("max_concurrent_chats", 3)
+    app.config["sync"].setdefault("flood_sleep_threshold", 60)
+    app.config["listener"] = config.get("listener", {})
+    app.config["listener"].setdefault("enabled", False)
+    app.config["alerts"] = config.get("alerts", {})
+    app.config["alerts"].setdefault("enabled", False)
+    app.config["alerts"].setdefault("max_age_hours", 72)
+    app.config["alerts"].setdefault("interval", 60)
+    app.config["alerts"].setdefault("batch_size", 10)
+    app.config["alerts"].setdefault("rate_per_minute", 20)
+    app.config["server"] = config.get("server", {})
+    app.config["server"].setdefault("threads", 32)
+    app.config["pipeline"] = config.get("pipeline", {})
+    app.config["pipeline"].setdefault("model", "ollama")
+    app.config["pipeline"].setdefault("concurrency", {"ollama": 4, "gemini": 2})
+    app.config["pipeline"].setdefault("lease_seconds", 600)
+    app.config["pipeline"].setdefault("mode", "two_stage")
+    app.config["pipeline"].setdefault("stream", True)
+    app.config["pipeline"].setdefault("keep_alive", "30m")
+    app.config["pipeline"].setdefault("classify_batch_size", 1)
+    app.config["pipeline"].setdefault("context_tokens", 4096)
+    if app.config["pipeline"]["mode"] not in PIPELINE_MODES:
+        raise ValueError(f"Invalid pipeline mode: {app.config['pipeline']['mode']}")
     
-    # Init mongodb client
-    mdb_client = MongoClient("mongodb://mongodb:27017", 
-                             serverSelectionTimeoutMS=3000,
-                             socketTimeoutMS=3000,
-                             connectTimeoutMS=3000,
-                             )
-    db = mdb_client["unitn-rents"]
+    # Init mongodb client. It is a thread safe connection pool, shared by the
+    # request threads, the jobs and the pipeline workers.
+    mdb_client = mongo_client
+    if mdb_client is None:
+        mdb_client = MongoClient(os.environ.get("MONGO_URL", "mongodb://mongodb:27017"),
+                                 serverSelectionTimeoutMS=3000,
+                                 socketTimeoutMS=3000,
+                                 connectTimeoutMS=3000,
+                                 )
+    db = mdb_client[db_name]
+    db_create_indexes(db)
+    rentals_create_indexes(db)
+    search_create_indexes(db)
+    stats_create_indexes(db)
+    if db["rentals"].estimated_document_count() == 0:
+        # first start with the rentals collection: build it from the processed messages
+        print(f"Built {rentals_rebuild(db)} rentals.")
+    if not stats_exist(db):
+        # first start with the stats: compute them once, then they are kept up to date
+        stats_rebuild(db)
+
+    # Init LLM HTTP clients
+    llm_client_init(config.get("llm", {}))
+    pipeline_init(stream=app.config["pipeline"]["stream"],
+                  keep_alive=app.config["pipeline"]["keep_alive"],
+                  classify_batch_size=app.config["pipeline"]["classify_batch_size"],
+                  context_tokens=app.config["pipeline"]["context_tokens"],
+                  )
+    if app.config["pipeline"]["model"] == "ollama":
+        # load the model in the background, so that the first message doesn't wait for it
+        threading.Thread(target=ollama_preload, name="ollama-preload", daemon=True).start()
+
+    # Init rule-based pre-filter
+    prefilter_config = config.get("prefilter", {})
+    prefilter_init(enabled=prefilter_config.get("enabled", True),
+                   reject_below=prefilter_config.get("reject_below", 0.1),
+                   accept_above=prefilter_config.get("accept_above", 0.95),
+                   )
+
+    # Init LLM result cache
+    llm_cache_config = config.get("llm_cache", {})
+    llm_cache_init(db,
+                   ttl_days=llm_cache_config.get("ttl_days", 30),
+                   max_distance=llm_cache_config.get("max_distance", 3),
+                   )
        
+    # Init saved-search alerts
+    alerts_init(db,
+                enabled=app.config["alerts"]["enabled"],
+                max_age_hours=app.config["alerts"]["max_age_hours"],
+                )
+
     # Get active chats
     @app.route("/active_chats", methods=["GET"])
     def get_active_chats():
@@ -45,140 +157,495 @@ def init_app():
         }
         try:
             db["active_chats"].insert_one(doc)
+            listener.refresh_active_chats()
             return "", 201
 
         except DuplicateKeyError:
             return "", 409
 
 
+    # Telegram client, shared by all the requests and jobs
+    telegram = TelegramService(app.config["telegram"]["api_id"],
+                               app.config["telegram"]["app_hash"],
+                               flood_sleep_threshold=app.config["sync"]["flood_sleep_threshold"],
+                               )
+    atexit.register(telegram.disconnect)
+
     # get available chats
     @app.route("/available_chats", methods=["GET"])
-    async def get_available_chats():
+    def get_available_chats():
 
-        # Init Telethon client
-        telegram_client = TelegramClient('rent-scraper',
-                            app.config["telegram"]["api_id"],
-                            app.config["telegram"]["app_hash"],
-                            )
-        await telegram_client.start()
+        async def list_dialogs(client):
+            dialog_names = []
+            async for dialog in client.iter_dialogs():
+                dialog_names.append(dialog.name)
+            return dialog_names
 
-        dialog_names = []
-        async for dialog in telegram_client.iter_dialogs():
-            dialog_names.append(dialog.name)
+        return jsonify(telegram.run(list_dialogs).result())
 
-        telegram_client.disconnect()
-        return jsonify(dialog_names)
 
+    # Alerts are sent as Telegram DMs from the shared client
+    if app.config["alerts"]["enabled"]:
+        AlertSender(db, telegram,
+                    interval=app.config["alerts"]["interval"],
+                    batch_size=app.config["alerts"]["batch_size"],
+                    rate_per_minute=app.config["alerts"]["rate_per_minute"],
+                    ).start()
 
-    # Sync messages
-    @app.route("/sync_messages", methods=["POST"])
-    async def sync_messages():
-        
-        # Init Telethon client
-        telegram_client = TelegramClient('rent-scraper',
-                            app.config["telegram"]["api_id"],
-                            app.config["telegram"]["app_hash"],
-                            )
-        await telegram_client.start() 
-
-        result_stats = {}
+    # Returns the saved searches of a user
+    @app.route("/users/<user_id>/searches", methods=["GET"])
+    def get_user_searches(user_id):
+        return jsonify(get_searches(db, user_id)), 200
+
+    # Saves a search: the user (Telegram username or id) gets a DM when a new
+    # rental matches it. Body: max_price, room_type, target_gender, amenities
+    # (list), near (campus), max_distance_km (default 2), all optional
+    @app.route("/users/<user_id>/searches", methods=["POST"])
+    def post_user_search(user_id):
+        try:
+            search = parse_search(request.get_json(force=True))
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": str(e)}), 400
+        add_search(db, user_id, search)
+        return jsonify(search), 201
+
+    @app.route("/users/<user_id>/searches/<search_id>", methods=["DELETE"])
+    def delete_user_search(user_id, search_id):
+        if not delete_search(db, user_id, search_id):
+            return jsonify({"error": "Search not found"}), 404
+        return "", 204
+
+    # Returns how many alerts are pending, sent and failed
+    @app.route("/alerts/stats", methods=["GET"])
+    def get_alerts_stats():
+        return jsonify(alerts_stats(db)), 200
+
+    # Background jobs
+    job_runner = JobRunner(db)
+
+    # Sync job: downloads all the new messages of the active chats
+    def sync_messages_job(job, params):
         active_chats = list(map(lambda x: x["_id"], db["active_chats"].find({})))
-        
-        async for dialog in telegram_client.iter_dialogs():
-            if (dialog.name not in active_chats):
-                continue
-            chat_name = dialog.name
-
-            # Get new messages
-            last_id = db_get_last_message_id(db, chat_name)
-            print(f"{dialog.name} - last id: {last_id}")
-
-            messages = []
-            async for msg in telegram_client.iter_messages(dialog,
-                                                           min_id=last_id,
-                                                           limit=100,
-                                                           ):
-                messages.append(msg)
-            
-            # Store messages
-            print(f"- storing {len(messages)} messages")
-            result_stats[chat_name] = db_store_messages_batch(db, chat_name, messages)
-        
-        telegram_client.disconnect()
-        return jsonify(result_stats), 200
+        fetched_count = 0
 
-    # Gets all non-processed telegram messages and processes them. 
-    @app.route("/run_pipeline", methods=["POST"])
-    def run_pipeline():
+        def on_start(estimated_total):
+            job.progress(processed=0, failed=0, total=estimated_total)
 
-        # start timer for metrics
-        start = time.perf_counter()
-    
-        # get gemini key if present
+        def on_batch(chat_name, fetched, stored):
+            nonlocal fetched_count
+            fetched_count += fetched
+            job.progress(processed=fetched_count)
+
+        return telegram.run(lambda client: sync_active_chats(
+            client, db, active_chats,
+            max_concurrent_chats=app.config["sync"]["max_concurrent_chats"],
+            batch_size=app.config["sync"]["batch_size"],
+            on_start=on_start,
+            on_batch=on_batch,
+            should_stop=job.cancelled,
+        )).result()
+
+    # get gemini key if present
+    def get_gemini_key():
         if app.config["gemini"]:
-            gemini_key = app.config["gemini"]["api_key"]
+            return app.config["gemini"]["api_key"]
+        return None
+
+    def new_worker_id():
+        return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
 
+    # Processes claimed messages with the configured backend, completing them
+    # as their results arrive. Returns (processed, failed)
+    def process_claimed_messages(job, worker_id, claimed_messages):
+        model = app.config["pipeline"]["model"]
+        mode = app.config["pipeline"]["mode"]
+        processed_with = get_processed_with(model, mode)
         processed_count = 0
-        
-        # Get all collections that contain messages (assuming they follow a pattern like chat names)
+        failed_count = 0
+
+        def on_result(message, result):
+            nonlocal processed_count
+            if is_failed_result(result):
+                on_error(message, ValueError("extraction failed"))
+                return
+            if not db_complete_claimed_message(db, message["_id"], worker_id, result["extracted_features"],
+                                               processed_with, result.get("decided_by")):
+                print(f"Lost lease on message {message['_id']}, discarding result.")
+                return
+            processed_count += 1
+            job.progress(processed=processed_count)
+            print(f"Processed {processed_count} messages.")
+
+        # Failed messages keep their lease until it expires, then they are retried
+        def on_error(message, error):
+            nonlocal failed_count
+            failed_count += 1
+            job.progress(failed=failed_count)
+
+        process_messages_concurrently(db, claimed_messages, on_result, on_error,
+                                      model=model,
+                                      gemini_key=get_gemini_key(),
+                                      concurrency=app.config["pipeline"]["concurrency"].get(model, 1),
+                                      mode=mode,
+                                      )
+        return processed_count, failed_count
+
+    # Pipeline job: processes all non-processed telegram messages
+    def run_pipeline_job(job, params):
+
+        # start timer for metrics
+        start = time.perf_counter()
+
         active_chats = list(map(lambda x: x["_id"], db["active_chats"].find({})))
-    
-        results = []
-        
-        for chat_name in active_chats:
-            # Find all unprocessed messages
-            unprocessed_messages = db["messages"].find({"__processed": {"$ne": True}})
-
-            for message in unprocessed_messages:
-                # Process the message
-                results.append(process_message(db, message, model="ollama", gemini_key=gemini_key))
-                #results.append(process_message(db, message, model="gemini", gemini_key=gemini_key))
-                
-                # Mark as processed
-                db["messages"].update_one(
-                    {"_id": message["_id"]}, 
-                    {"$set": {"__processed": True, "extracted_features": results[-1]["extracted_features"]}}
-                )
-                processed_count += 1
-                print(f"Processed {processed_count} messages.")
-      
+        total = db["messages"].count_documents({
+            "chat_name": {"$in": active_chats},
+            "__processed": {"$ne": True},
+        })
+        job.progress(processed=0, failed=0, total=total)
+
+        # Claim unprocessed messages of the active chats one at a time, so that
+        # multiple pipeline runs can drain the backlog in parallel
+        worker_id = new_worker_id()
+        claimed_messages = db_iter_claimed_messages(db, active_chats, worker_id,
+                                                    lease_seconds=app.config["pipeline"]["lease_seconds"],
+                                                    should_stop=job.cancelled,
+                                                    )
+        processed_count, failed_count = process_claimed_messages(job, worker_id, claimed_messages)
+
         end = time.perf_counter()
         elapsed = end - start  # seconds as float
 
-        print(f"Processed {processed_count} messages in {elapsed:.6f} seconds.")
-        return jsonify({"processed_messages": results, "elapsed_time": elapsed }), 200
+        print(f"Processed {processed_count} messages ({failed_count} failed) in {elapsed:.6f} seconds.")
+        return {"processed": processed_count, "failed": failed_count, "elapsed_time": elapsed}
+
+    # Re-extraction job: processes again, newest first, the messages processed
+    # with another model or prompt version than the current ones. They keep
+    # their old features until the new ones are stored.
+    def reextract_job(job, params):
+        processed_with = get_processed_with(app.config["pipeline"]["model"], app.config["pipeline"]["mode"])
+        job.progress(processed=0, failed=0, total=db_count_stale_messages(db, processed_with))
 
+        worker_id = new_worker_id()
+        stale_messages = db_iter_stale_messages(db, processed_with, worker_id,
+                                                lease_seconds=app.config["pipeline"]["lease_seconds"],
+                                                should_stop=job.cancelled,
+                                                )
+        processed_count, failed_count = process_claimed_messages(job, worker_id, stale_messages)
+        return {"processed": processed_count, "failed": failed_count, "processed_with": processed_with}
 
+    # Dry run of the re-extraction on the newest stale messages: reports which
+    # fields would change, without storing anything
+    def reextract_diff_job(job, params):
+        model = app.config["pipeline"]["model"]
+        mode = app.config["pipeline"]["mode"]
+        processed_with = get_processed_with(model, mode)
+        limit = params.get("limit", 50)
+        job.progress(processed=0, failed=0, total=min(limit, db_count_stale_messages(db, processed_with)))
+
+        def on_progress(report):
+            job.progress(processed=report["checked"], failed=report["failed"])
+
+        report = reextract_diff_report(db, processed_with, limit,
+                                       model=model,
+                                       gemini_key=get_gemini_key(),
+                                       mode=mode,
+                                       concurrency=app.config["pipeline"]["concurrency"].get(model, 1),
+                                       on_progress=on_progress,
+                                       )
+        return {**report, "processed_with": processed_with}
+
+    job_runner.register("sync", sync_messages_job)
+    job_runner.register("pipeline", run_pipeline_job)
+    job_runner.register("reextract", reextract_job)
+    job_runner.register("reextract_diff", reextract_diff_job)
+
+    # Real-time ingestion: messages received by the listener are processed right away
+    live_worker_id = new_worker_id()
+
+    def process_live_message(chat_name, message_id):
+        message = db_claim_message(db, chat_name, message_id, live_worker_id,
+                                   lease_seconds=app.config["pipeline"]["lease_seconds"],
+                                   )
+        if message is None:
+            # already processed, or being processed by someone else
+            return
+        result = process_message(db, message,
+                                 model=app.config["pipeline"]["model"],
+                                 gemini_key=get_gemini_key(),
+                                 mode=app.config["pipeline"]["mode"],
+                                 )
+        if is_failed_result(result):
+            # the lease expires, and the pipeline job retries it
+            print(f"Extraction failed for live message {chat_name}/{message_id}.")
+            return
+        processed_with = get_processed_with(app.config["pipeline"]["model"], app.config["pipeline"]["mode"])
+        if db_complete_claimed_message(db, message["_id"], live_worker_id, result["extracted_features"], processed_with,
+                                       result.get("decided_by")):
+            print(f"Processed live message {chat_name}/{message_id}.")
+
+    live_worker = None
+
+    def on_live_message(chat_name, message_id):
+        live_worker.enqueue(chat_name, message_id)
+
+    listener = TelegramListener(telegram, db, on_live_message)
+
+    def start_listener():
+        nonlocal live_worker
+        if live_worker is None:
+            model = app.config["pipeline"]["model"]
+            live_worker = LivePipelineWorker(process_live_message,
+                                             concurrency=app.config["pipeline"]["concurrency"].get(model, 1),
+                                             )
+        listener.start()
+
+    if app.config["listener"]["enabled"]:
+        start_listener()
+
+    def queue_depth():
+        stats = stats_counts(db)
+        return {
+            ("live",): live_worker.pending() if live_worker else 0,
+            ("backlog",): stats["messages"] - stats["processed"],
+        }
+
+    QUEUE_DEPTH.set_function(queue_depth)
+
+    @app.route("/listener", methods=["GET"])
+    def get_listener_status():
+        return jsonify({**listener.status(), "pending": live_worker.pending() if live_worker else 0}), 200
+
+    @app.route("/listener/start", methods=["POST"])
+    def post_listener_start():
+        start_listener()
+        return "", 204
+
+    @app.route("/listener/stop", methods=["POST"])
+    def post_listener_stop():
+        listener.stop()
+        return "", 204
+
+    # Starts a job of the given type, unless one is already queued or running.
+    # With own_only, only the jobs of this process count: pipeline runs claim
+    # their messages with a lease, so each process can run its own.
+    def start_job(job_type, params=None, own_only=False):
+        active_job = job_runner.find_active(job_type, own_only)
+        if active_job:
+            return jsonify({"job_id": active_job["_id"]}), 200
+        job_id = job_runner.enqueue(job_type, params)
+        return jsonify({"job_id": job_id}), 202
+
+    # Sync messages
+    @app.route("/sync_messages", methods=["POST"])
+    def sync_messages():
+        return start_job("sync")
+
+    # Gets all non-processed telegram messages and processes them. 
+    @app.route("/run_pipeline", methods=["POST"])
+    def run_pipeline():
+        return start_job("pipeline", own_only=True)
+
+    # Returns how many processed messages come from another model or prompt
+    # version than the current ones
+    @app.route("/reextract/stale", methods=["GET"])
+    def get_stale_count():
+        processed_with = get_processed_with(app.config["pipeline"]["model"], app.config["pipeline"]["mode"])
+        return jsonify({"count": db_count_stale_messages(db, processed_with), "processed_with": processed_with}), 200
+
+    # Re-extracts the stale messages in the background. With ?dry_run=true,
+    # re-extracts only the `limit` (default 50) newest ones without storing the
+    # results, and the job result reports which fields would change
+    @app.route("/reextract", methods=["POST"])
+    def reextract():
+        if request.args.get("dry_run") == "true":
+            return start_job("reextract_diff", {"limit": request.args.get("limit", 50, type=int)})
+        return start_job("reextract", own_only=True)
+
+    # Returns the most recent jobs
+    @app.route("/jobs", methods=["GET"])
+    def get_jobs():
+        return jsonify(job_runner.recent()), 200
+
+    # Returns the status of a job, with progress, rate and ETA
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    def get_job(job_id):
+        job = job_runner.get(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job), 200
+
+    # Streams the status of a job as Server-Sent Events, until it ends. Every
+    # stream holds a server thread, and clients that go away are not noticed,
+    # so streams are closed after 5 minutes (EventSource reconnects by itself).
+    @app.route("/jobs/<job_id>/events", methods=["GET"])
+    def stream_job(job_id):
+        if not job_runner.get(job_id):
+            return jsonify({"error": "Job not found"}), 404
+
+        def events():
+            deadline = time.monotonic() + 300
+            while True:
+                job = job_runner.get(job_id)
+                yield f"data: {json.dumps(job, default=str)}\n\n"
+                if job["status"] not in ACTIVE_STATUSES or time.monotonic() > deadline:
+                    return
+                time.sleep(1)
+
+        return Response(events(), mimetype="text/event-stream")
+
+    @app.route("/jobs/<job_id>/cancel", methods=["POST"])
+    def cancel_job(job_id):
+        if not job_runner.cancel(job_id):
+            return jsonify({"error": "Job not found or not running"}), 409
+        return "", 202
+
+    @app.route("/jobs/<job_id>/resume", methods=["POST"])
+    def resume_job(job_id):
+        if not job_runner.resume(job_id):
+            return jsonify({"error": "Job not found or not resumable"}), 409
+        return jsonify({"job_id": job_id}), 202
 
     # Returns the total number of messages
     @app.route("/messages/count/total", methods=["GET"])
     def get_total_messages_count():
-        count = db["messages"].count_documents({})
-        return jsonify({"count": count}), 200
+        return jsonify({"count": stats_counts(db)["messages"]}), 200
 
     # Returns the number of processed messages
     @app.route("/messages/count/processed", methods=["GET"])
     def get_processed_messages_count():
-        count = db["messages"].count_documents({"__processed": True})
-        return jsonify({"count": count}), 200
+        return jsonify({"count": stats_counts(db)["processed"]}), 200
 
+    # Returns the message and rental counts, the median price per room type and
+    # the listings per chat per day of the last `days` (default 30) days, all
+    # kept up to date as messages are stored and processed
+    @app.route("/stats", methods=["GET"])
+    def get_stats():
+        days = min(max(request.args.get("days", 30, type=int), 0), 365)
+        return jsonify(stats_get(db, days)), 200
 
-    # Returns all processed messages
+    # Full-text search of the announcements. Query parameters: q (words,
+    # "quoted phrases", -excluded words), limit, skip, all=true to search all
+    # the messages, not only the rental announcements
+    @app.route("/search", methods=["GET"])
+    def search():
+        query = request.args.get("q", "").strip()
+        if not query:
+            return jsonify({"error": "Missing 'q' parameter"}), 400
+        limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+        skip = max(request.args.get("skip", 0, type=int), 0)
+        results, total = search_messages(db, query, limit, skip, rentals_only=request.args.get("all") != "true")
+        return jsonify({"items": results, "total": total}), 200
+
+
+    # Streams a gzipped NDJSON backup of the database. Query parameters: since
+    # (ISO date, only the messages stored or changed since then), collections
+    # (comma separated)
+    @app.route("/backup", methods=["GET"])
+    def get_backup():
+        args = request.args
+        try:
+            since = datetime.fromisoformat(args["since"]) if args.get("since") else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        collections = args["collections"].split(",") if args.get("collections") else BACKUP_COLLECTIONS
+        if any(name not in BACKUP_COLLECTIONS for name in collections):
+            return jsonify({"error": f"Collections must be among {', '.join(BACKUP_COLLECTIONS)}"}), 400
+
+        filename = f"unitn-rents-{datetime.now():%Y%m%d-%H%M%S}.ndjson.gz"
+        return Response(
+            gzip_chunks(export_ndjson(db, collections, since)),
+            mimetype="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+
+    # Restores a backup made with /backup, sent as the request body. Documents
+    # are upserted in batches, so a failed restore can be sent again, or resumed
+    # with the `skip` query parameter (lines_done of the failed response).
+    @app.route("/restore", methods=["POST"])
+    def restore_backup():
+        skip = request.args.get("skip", 0, type=int)
+        progress = {"lines_done": skip}
+
+        def on_batch(lines_done):
+            progress["lines_done"] = lines_done
+
+        lines = gzip.GzipFile(fileobj=request.stream)
+        try:
+            counts = restore_ndjson(db, lines, skip=skip, on_batch=on_batch)
+        except Exception as e:
+            return jsonify({"error": str(e), **progress}), 500
+        finally:
+            # the restored users may have saved searches, even if it failed halfway
+            alerts_reload(db)
+        if counts.get("messages"):
+            rentals_rebuild(db)
+        return jsonify({"restored": counts, **progress}), 200
+
+
+    # Pipeline metrics in the Prometheus text format
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+    # Returns the LLM result cache hit rate
+    @app.route("/llm_cache/stats", methods=["GET"])
+    def get_llm_cache_stats():
+        return jsonify(cache_stats(db)), 200
+
+
+    # Returns how many messages the pre-filter decided without the LLM
+    @app.route("/prefilter/stats", methods=["GET"])
+    def get_prefilter_stats():
+        return jsonify(prefilter_stats(db)), 200
+
+
+    # Returns a page of processed messages, filtered and sorted.
+    # Query parameters: min_price, max_price, room_type, target_gender,
+    # utilities_included (true/false), amenities (comma separated), location,
+    # date_from, date_to (ISO dates), near (campus: povo, mesiano, centro, or
+    # "lat,lon"), max_distance_km, sort (price-asc, price-desc, date-asc,
+    # date-desc, distance), limit, cursor (next_cursor of the previous page)
     @app.route("/processed_messages", methods=["GET"])
     def fetch_processed_message():
-        
-        processed_messages = db["messages"].find(
-            {"extracted_features": {"$ne": None}},
-            {"extracted_features": 1, "date": 1, "_id": 0} 
-        )
-        
-        # By default, the find method returns a cursor, so we need to iterate on it
-        results = []
-        for msg in processed_messages:
-            tmp = msg["extracted_features"]
-            tmp["date"] = msg["date"]
-            results.append(tmp)
-        return jsonify(results), 200
+        args = request.args
+        try:
+            filters = {
+                "min_price": args.get("min_price", type=float),
+                "max_price": args.get("max_price", type=float),
+                "room_type": args.get("room_type"),
+                "target_gender": args.get("target_gender"),
+                "utilities_included": {"true": True, "false": False}.get(args.get("utilities_included")),
+                "amenities": [a for a in args.get("amenities", "").split(",") if a],
+                "location": args.get("location"),
+                "date_from": datetime.fromisoformat(args["date_from"]) if args.get("date_from") else None,
+                "date_to": datetime.fromisoformat(args["date_to"]) if args.get("date_to") else None,
+                "near": parse_place(args["near"]) if args.get("near") else None,
+                "max_distance_km": args.get("max_distance_km", type=float),
+            }
+            sort = args.get("sort", "date-desc")
+            if sort not in PROCESSED_MESSAGES_SORTS:
+                raise ValueError(f"Invalid sort: {sort}")
+            limit = min(max(args.get("limit", 24, type=int), 1), 100)
+
+            items, total, next_cursor = db_query_processed_messages(db, filters, sort, limit, args.get("cursor"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({
+            "items": items,
+            "total": total,
+            "next_cursor": next_cursor,
+            "max_price": db_get_max_price(db),
+        }), 200
+
+
+    # Returns the campuses usable as "near" in /processed_messages
+    @app.route("/campuses", methods=["GET"])
+    def get_campuses():
+        return jsonify(CAMPUSES), 200
 
 
     # Manually extract data from single message, mostly for testing purposes
@@ -190,6 +657,16 @@ def init_app():
     return app
 
 
+# The Flask app on a pool of `server.threads` threads behind an ASGI server, so
+# that slow requests (SSE job streams, backups, Telegram calls) don't hold up
+# the others. Always a single process: the Telegram client, the listener and
+# the jobs live in it.
+def init_asgi_app(config=None):
+    app = init_app(config)
+    return WSGIMiddleware(app, workers=app.config["server"]["threads"])
+
+
 if __name__ == "__main__":
-    app = init_app()
-    app.run(host="0.0.0.0", port="9009")
+    import uvicorn
+
+    uvicorn.run(init_asgi_app(), host="0.0.0.0", port=9009)
@@ -0,0 +1,260 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Background jobs (message sync, pipeline runs) persisted in the `jobs` collection.
+#
+# A job document looks like:
+# {
+#     "_id": "uuid",
+#     "type": "sync" | "pipeline",
+#     "status": "queued" | "running" | "completed" | "failed" | "cancelled" | "interrupted",
+#     "progress": {"processed": int, "failed": int, "total": int or None},
+#     "result": {...} or None,
+#     "error": "string" or None,
+#     "cancel_requested": bool,
+#     "owner": "string", the JobRunner (process) running the job,
+#     "lease_until": datetime,
+#     "created_at", "started_at", "updated_at", "finished_at": datetime,
+# }
+#
+# Several processes can share the jobs collection: each JobRunner renews the
+# lease of its queued and running jobs, and the active jobs whose lease expired
+# (their process died) are marked interrupted, so they can be resumed.
+
+ACTIVE_STATUSES = ["queued", "running"]
+RESUMABLE_STATUSES = ["failed", "cancelled", "interrupted"]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _as_utc(date):
+    # pymongo returns naive datetimes, which are always UTC
+    if date is not None and date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
+
+
+# Handle passed to the job functions, used to report progress and to check
+# whether the user asked to stop the job.
+class JobContext:
+    def __init__(self, db, job_id, check_interval=1.0):
+        self.db = db
+        self.job_id = job_id
+        self.check_interval = check_interval
+        self._last_check = 0
+        self._cancelled = False
+
+    def progress(self, processed=None, failed=None, total=None):
+        update = {"updated_at": _now()}
+        if processed is not None:
+            update["progress.processed"] = processed
+        if failed is not None:
+            update["progress.failed"] = failed
+        if total is not None:
+            update["progress.total"] = total
+        self.db["jobs"].update_one({"_id": self.job_id}, {"$set": update})
+
+    # Cheap enough to be called once per processed item: the DB is read at most
+    # once every `check_interval` seconds.
+    def cancelled(self):
+        if self._cancelled:
+            return True
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            job = self.db["jobs"].find_one({"_id": self.job_id}, {"cancel_requested": 1})
+            self._cancelled = bool(job and job.get("cancel_requested"))
+        return self._cancelled
+
+    def raise_if_cancelled(self):
+        if self.cancelled():
+            raise JobCancelled()
+
+
+class JobRunner:
+    def __init__(self, db, max_workers=2, lease_seconds=60):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.job_types = {}
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+
+        self.interrupt_expired()
+        threading.Thread(target=self._heartbeat, name="jobs-heartbeat", daemon=True).start()
+
+    def _lease_until(self):
+        return _now() + timedelta(seconds=self.lease_seconds)
+
+    # Marks the active jobs whose owner stopped renewing their lease (or that
+    # predate leases) as interrupted, so they can be resumed
+    def interrupt_expired(self):
+        self.db["jobs"].update_many(
+            {
+                "status": {"$in": ACTIVE_STATUSES},
+                "$or": [{"lease_until": None}, {"lease_until": {"$lt": _now()}}],
+            },
+            {"$set": {"status": "interrupted", "updated_at": _now()}}
+        )
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self.db["jobs"].update_many(
+                    {"owner": self.owner, "status": {"$in": ACTIVE_STATUSES}},
+                    {"$set": {"lease_until": self._lease_until()}}
+                )
+                self.interrupt_expired()
+            except Exception:
+                traceback.print_exc()
+
+    # Registers a job type. `fn(job, params)` receives a JobContext and the
+    # params given at enqueue time, and returns the job result. It may be a
+    # coroutine function, in which case it runs in its own event loop.
+    def register(self, job_type, fn):
+        self.job_types[job_type] = fn
+
+    def enqueue(self, job_type, params=None):
+        if job_type not in self.job_types:
+            raise ValueError(f"Unknown job type: {job_type}")
+        now = _now()
+        job = {
+            "_id": uuid.uuid4().hex,
+            "type": job_type,
+            "params": params or {},
+            "status": "queued",
+            "progress": {"processed": 0, "failed": 0, "total": None},
+            "result": None,
+            "error": None,
+            "cancel_requested": False,
+            "owner": self.owner,
+            "lease_until": self._lease_until(),
+            "created_at": now,
+            "started_at": None,
+            "updated_at": now,
+            "finished_at": None,
+        }
+        self.db["jobs"].insert_one(job)
+        self.executor.submit(self._run, job["_id"])
+        return job["_id"]
+
+    # Returns an active job of the given type, of any process, or only of this
+    # one with own_only
+    def find_active(self, job_type, own_only=False):
+        query = {"type": job_type, "status": {"$in": ACTIVE_STATUSES}, "lease_until": {"$gte": _now()}}
+        if own_only:
+            query["owner"] = self.owner
+        return self.db["jobs"].find_one(query)
+
+    def cancel(self, job_id):
+        res = self.db["jobs"].update_one(
+            {"_id": job_id, "status": {"$in": ACTIVE_STATUSES}},
+            {"$set": {"cancel_requested": True, "updated_at": _now()}}
+        )
+        return res.modified_count == 1
+
+    # Re-runs a stopped job. Jobs are written so that running them again picks
+    # up where they stopped (messages already synced/processed are skipped).
+    def resume(self, job_id):
+        res = self.db["jobs"].update_one(
+            {"_id": job_id, "status": {"$in": RESUMABLE_STATUSES}},
+            {"$set": {
+                "status": "queued",
+                "cancel_requested": False,
+                "error": None,
+                "owner": self.owner,
+                "lease_until": self._lease_until(),
+                "finished_at": None,
+                "updated_at": _now(),
+            }}
+        )
+        if res.modified_count != 1:
+            return False
+        self.executor.submit(self._run, job_id)
+        return True
+
+    def get(self, job_id):
+        job = self.db["jobs"].find_one({"_id": job_id}, {"params": 0})
+        return job_status(job) if job else None
+
+    def recent(self, limit=20):
+        jobs = self.db["jobs"].find({}, {"params": 0, "result": 0}).sort("created_at", -1).limit(limit)
+        return [job_status(job) for job in jobs]
+
+    def _run(self, job_id):
+        job = self.db["jobs"].find_one_and_update(
+            {"_id": job_id, "status": "queued", "owner": self.owner},
+            {"$set": {"status": "running", "started_at": _now(), "updated_at": _now()}},
+            return_document=True,
+        )
+        if job is None:
+            return
+        if job["cancel_requested"]:
+            self._finish(job_id, "cancelled")
+            return
+
+        ctx = JobContext(self.db, job_id)
+        fn = self.job_types[job["type"]]
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                result = asyncio.run(fn(ctx, job["params"]))
+            else:
+                result = fn(ctx, job["params"])
+        except JobCancelled:
+            self._finish(job_id, "cancelled")
+        except Exception as e:
+            traceback.print_exc()
+            self._finish(job_id, "failed", error=str(e))
+        else:
+            self._finish(job_id, "cancelled" if ctx.cancelled() else "completed", result=result)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = _now()
+        self.db["jobs"].update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": status,
+                "result": result,
+                "error": error,
+                "updated_at": now,
+                "finished_at": now,
+            }}
+        )
+        print(f"Job {job_id} {status}.")
+
+
+# Adds elapsed time, rate (items/s) and ETA to a job document
+def job_status(job):
+    progress = job["progress"]
+    started_at = _as_utc(job.get("started_at"))
+    end = _as_utc(job.get("finished_at")) or _now()
+
+    elapsed = (end - started_at).total_seconds() if started_at else 0
+    done = progress["processed"] + progress["failed"]
+    rate = done / elapsed if elapsed > 0 else None
+
+    eta = None
+    if job["status"] == "running" and rate and progress["total"] is not None:
+        eta = max(progress["total"] - done, 0) / rate
+
+    for key in ["created_at", "started_at", "updated_at", "finished_at", "lease_until"]:
+        if job.get(key):
+            job[key] = _as_utc(job[key]).isoformat()
+
+    job["id"] = job.pop("_id")
+    job["elapsed_time"] = elapsed
+    job["rate"] = rate
+    job["eta"] = eta
+    return job
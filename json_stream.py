@@ -0,0 +1,52 @@
+# Incremental scanner for the first top-level JSON object in a stream of text,
+# used to stop reading an LLM response as soon as the object is complete, and
+# to ignore whatever the model writes before or after it.
+class JsonObjectScanner:
+    def __init__(self):
+        self.parts = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+
+    # Feeds the next chunk of text. Returns the text of the object once its
+    # closing brace is read, None until then (and after).
+    def feed(self, chunk):
+        if self.done:
+            return None
+        # where the object starts in this chunk
+        start = 0 if self.depth > 0 else None
+
+        for i, char in enumerate(chunk):
+            if self.depth == 0:
+                if char == "{":
+                    start = i
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(chunk[start:i + 1])
+                    self.done = True
+                    return "".join(self.parts)
+
+        if start is not None:
+            self.parts.append(chunk[start:])
+        return None
+
+
+# Returns the text of the first complete top-level JSON object in `text`, or None
+def first_json_object(text):
+    return JsonObjectScanner().feed(text)
@@ -0,0 +1,163 @@
+import hashlib
+import re
+import unicodedata
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+# Persistent cache of LLM results, so that reposted announcements (same text in
+# several chats, or the same announcement posted again every week) skip inference.
+#
+# Entries are keyed by the normalized text + model name + prompt version. Near
+# duplicates (e.g. the same announcement with a different phone number or emoji)
+# are found with a 64 bit SimHash of the text: the hash is split in 4 bands of 16
+# bits, so any two hashes within 3 bits of each other share at least one band,
+# and only the entries sharing a band need to be compared.
+
+CACHE_COLLECTION = "llm_cache"
+STATS_COLLECTION = "llm_cache_stats"
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+
+# Can be changed with llm_cache_init
+settings = {
+    "ttl_days": 30,
+    "max_distance": 3,
+}
+
+
+def llm_cache_init(db, ttl_days=30, max_distance=3):
+    # bands can only guarantee a match up to (SIMHASH_BANDS - 1) different bits
+    settings["ttl_days"] = ttl_days
+    settings["max_distance"] = min(max_distance, SIMHASH_BANDS - 1)
+
+    db[CACHE_COLLECTION].create_index([("model", ASCENDING), ("prompt_version", ASCENDING), ("bands", ASCENDING)])
+    # create_index fails if the index exists with another TTL: change it instead
+    ttl_seconds = int(ttl_days * 24 * 3600)
+    ttl_index = db[CACHE_COLLECTION].index_information().get("last_hit_at_1")
+    if ttl_index is None:
+        db[CACHE_COLLECTION].create_index("last_hit_at", expireAfterSeconds=ttl_seconds)
+    elif ttl_index.get("expireAfterSeconds") != ttl_seconds:
+        db.command("collMod", CACHE_COLLECTION,
+                   index={"keyPattern": {"last_hit_at": 1}, "expireAfterSeconds": ttl_seconds})
+
+
+# Lowercases, strips accents, emoji and punctuation, and collapses whitespace
+def normalize_text(text):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s€]", " ", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+# Italian phone numbers, whose digits may be grouped with spaces, dots or dashes
+# ("333 123 4567", "347.987.6543", "0461 123456")
+PHONE_NUMBER = re.compile(
+    r"(?<![\d.,])(?:(?:\+|00)39[ .\-]?)?"
+    r"(?:3\d{2}[ .\-]?(?:\d{7}|\d{3}[ .\-]?\d{4}|\d{2}[ .\-]?\d{2}[ .\-]?\d{3})|0\d{1,3}[ \-]?\d{5,8})"
+    r"(?!\d)"
+)
+# "1.200": one number, with a thousands separator
+THOUSANDS = re.compile(r"(?<![\d.,])\d{1,3}(?:\.\d{3})+(?![\d.]?\d)")
+
+# Short numbers (prices, sizes, floors...) must match exactly for two
+# announcements to be near duplicates; phone numbers and other long numbers
+# may differ. Taken from the raw text, since normalize_text can't tell "1.200"
+# from "1 200", or a phone number from the numbers around it.
+def _short_numbers(text):
+    text = PHONE_NUMBER.sub(" ", text or "")
+    text = THOUSANDS.sub(lambda match: match.group().replace(".", ""), text)
+    return " ".join(sorted(n for n in re.findall(r"\d+", text) if len(n) <= 5))
+
+def simhash(normalized):
+    tokens = re.sub(r"\d+", " ", normalized).split()
+    shingles = [" ".join(tokens[i:i + 2]) for i in range(max(len(tokens) - 1, 1))]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.md5(shingle.encode()).digest()[:8], "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+def _bands(hash_value):
+    band_bits = SIMHASH_BITS // SIMHASH_BANDS
+    mask = (1 << band_bits) - 1
+    return [f"{i}:{hash_value >> (i * band_bits) & mask:04x}" for i in range(SIMHASH_BANDS)]
+
+def _cache_key(normalized, model_name, prompt_version):
+    return hashlib.sha256(f"{model_name}|{prompt_version}|{normalized}".encode()).hexdigest()
+
+
+def _count(db, outcome):
+    db[STATS_COLLECTION].update_one({"_id": "stats"}, {"$inc": {outcome: 1}}, upsert=True)
+
+# Returns the cached result for `text`, or None.
+def cache_lookup(db, text, model_name, prompt_version):
+    normalized = normalize_text(text)
+    now = datetime.now(timezone.utc)
+
+    entry = db[CACHE_COLLECTION].find_one_and_update(
+        {"_id": _cache_key(normalized, model_name, prompt_version)},
+        {"$set": {"last_hit_at": now}, "$inc": {"hits": 1}},
+    )
+    if entry:
+        _count(db, "exact_hits")
+        return entry["result"]
+
+    hash_value = simhash(normalized)
+    candidates = db[CACHE_COLLECTION].find({
+        "model": model_name,
+        "prompt_version": prompt_version,
+        "numbers": _short_numbers(text),
+        "bands": {"$in": _bands(hash_value)},
+    }, {"simhash": 1, "result": 1})
+    for entry in candidates:
+        if bin(int(entry["simhash"], 16) ^ hash_value).count("1") <= settings["max_distance"]:
+            db[CACHE_COLLECTION].update_one(
+                {"_id": entry["_id"]},
+                {"$set": {"last_hit_at": now}, "$inc": {"hits": 1}},
+            )
+            _count(db, "near_hits")
+            return entry["result"]
+
+    _count(db, "misses")
+    return None
+
+def cache_store(db, text, model_name, prompt_version, result):
+    normalized = normalize_text(text)
+    hash_value = simhash(normalized)
+    now = datetime.now(timezone.utc)
+    try:
+        db[CACHE_COLLECTION].insert_one({
+            "_id": _cache_key(normalized, model_name, prompt_version),
+            "model": model_name,
+            "prompt_version": prompt_version,
+            "simhash": f"{hash_value:016x}",
+            "bands": _bands(hash_value),
+            "numbers": _short_numbers(text),
+            "result": result,
+            "hits": 0,
+            "created_at": now,
+            "last_hit_at": now,
+        })
+    except DuplicateKeyError:
+        # another worker cached the same text in the meantime
+        pass
+
+def cache_stats(db):
+    stats = db[STATS_COLLECTION].find_one({"_id": "stats"}) or {}
+    exact_hits = stats.get("exact_hits", 0)
+    near_hits = stats.get("near_hits", 0)
+    misses = stats.get("misses", 0)
+    lookups = exact_hits + near_hits + misses
+    return {
+        "entries": db[CACHE_COLLECTION].estimated_document_count(),
+        "lookups": lookups,
+        "exact_hits": exact_hits,
+        "near_hits": near_hits,
+        "misses": misses,
+        "hit_rate": (exact_hits + near_hits) / lookups if lookups else None,
+    }
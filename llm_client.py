@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import RateLimiter
+
+# Shared HTTP layer for the LLM backends: one pooled keep-alive session per
+# backend, per-call timeouts, retries with exponential backoff and jitter, a
+# client-side rate limiter (for the Gemini quotas) and a circuit breaker, so
+# that a dead backend fails fast instead of stalling every message.
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+DEFAULT_SETTINGS = {
+    "ollama": {
+        "connect_timeout": 5,
+        # generation on CPU can take minutes
+        "read_timeout": 300,
+        "max_retries": 2,
+        "rate_per_minute": None,
+    },
+    "gemini": {
+        "connect_timeout": 5,
+        "read_timeout": 60,
+        "max_retries": 4,
+        # free tier quota of gemini-2.0-flash
+        "rate_per_minute": 15,
+    },
+}
+COMMON_DEFAULTS = {
+    "backoff_base": 1,
+    "backoff_max": 30,
+    "failure_threshold": 5,
+    "reset_timeout": 60,
+    "pool_size": 16,
+}
+
+# Backend to switch to when one is failing, e.g. {"ollama": "gemini"}.
+# Can be changed with llm_client_init
+failover = {}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# After `failure_threshold` consecutive failures the circuit opens and calls
+# fail immediately. After `reset_timeout` seconds one call is let through: if it
+# succeeds the circuit closes, otherwise it stays open for another period.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half-open: let this call through, and keep the others out
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LLMClient:
+    def __init__(self, name, connect_timeout=5, read_timeout=60, max_retries=2,
+                 backoff_base=1, backoff_max=30, rate_per_minute=None,
+                 failure_threshold=5, reset_timeout=60, pool_size=16):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(rate_per_minute) if rate_per_minute else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # "Full jitter" backoff: a random delay up to base * 2^attempt
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # POSTs to the backend and returns the response. Connection errors,
+    # timeouts and RETRY_STATUSES are retried; other HTTP errors are raised
+    # right away.
+    def post(self, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = self._backoff(attempt - 1, getattr(error, "retry_after", None))
+                print(f"{self.name}: {error}, retrying in {delay:.1f}s ({attempt}/{self.max_retries})")
+                time.sleep(delay)
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            try:
+                response = self.session.post(url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                error = requests.HTTPError(f"{response.status_code} from {self.name}", response=response)
+                retry_after = response.headers.get("Retry-After")
+                error.retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                # give the connection back to the pool, streamed bodies are not read
+                response.close()
+                continue
+
+            if not response.ok:
+                response.close()
+            response.raise_for_status()
+            self.breaker.record_success()
+            return response
+
+        self.breaker.record_failure()
+        raise error
+
+
+# config: {"ollama": {...}, "gemini": {...}, "failover": {...}}, plus any of
+# COMMON_DEFAULTS to apply to both backends
+def llm_client_init(config):
+    common = {key: config[key] for key in COMMON_DEFAULTS if key in config}
+    with _clients_lock:
+        _clients.clear()
+        for name in DEFAULT_SETTINGS:
+            settings = {**COMMON_DEFAULTS, **common, **DEFAULT_SETTINGS[name], **(config.get(name) or {})}
+            _clients[name] = LLMClient(name, **settings)
+    failover.clear()
+    failover.update(config.get("failover") or {})
+
+def get_client(name):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = LLMClient(name, **COMMON_DEFAULTS, **DEFAULT_SETTINGS[name])
+        return _clients[name]
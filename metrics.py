@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal in-process metrics in the Prometheus text format, served on /metrics.
+# Counters, gauges and histograms with labels; all thread safe.
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return lines + self._samples()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def _samples(self):
+        with self.lock:
+            return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self.values.items()]
+
+
+# A gauge is either set, or computed at every scrape by a function returning
+# {labels tuple: value} (or a number, for gauges without labels)
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if self.function:
+            try:
+                computed = self.function()
+            except Exception as e:
+                print(f"Could not compute {self.name}: {e}")
+                computed = {}
+            if not isinstance(computed, dict):
+                computed = {(): computed}
+            for labels, value in computed.items():
+                values[tuple(zip(self.labelnames, labels))] = value
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values.items()]
+
+
+# LLM calls take from a fraction of a second (Gemini) to minutes (Ollama on CPU)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    # with histogram.time(stage="extract"): ...
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {bucket_count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+def render_metrics():
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# Pipeline metrics. "backend" is ollama/gemini for the LLM stages, telegram and
+# mongo for the sync ones.
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds",
+    "Time spent in each pipeline stage (telegram_fetch, mongo_write, classify, classify_batch, extract, classify_extract, json_parse)",
+    ["stage", "backend"],
+)
+LLM_REQUEST_SECONDS = Histogram("llm_request_seconds", "Latency of the LLM HTTP requests", ["backend"])
+LLM_REQUESTS = Counter("llm_requests_total", "LLM HTTP requests by outcome (ok, error)", ["backend", "status"])
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens reported by the backends", ["backend", "kind"])
+LLM_STREAM_STOPS = Counter("llm_stream_stops_total", "Streamed LLM responses closed as soon as the answer was complete", ["backend"])
+CLASSIFY_BATCHES = Counter("llm_classify_batches_total", "Batched classifications by result (ok; mismatch, error: classified one at a time)", ["backend", "result"])
+JSON_PARSE = Counter("llm_json_parse_total", "Parsing of the LLM JSON responses by result (ok, error)", ["backend", "result"])
+MESSAGES_PROCESSED = Counter(
+    "pipeline_messages_total",
+    "Messages through the pipeline by outcome (rejected, cached, positive, negative, extraction_error, error)",
+    ["outcome"],
+)
+TELEGRAM_MESSAGES = Counter("telegram_messages_fetched_total", "Messages downloaded from Telegram")
+IN_FLIGHT = Gauge("pipeline_in_flight", "Messages being processed by the pipeline jobs")
+QUEUE_DEPTH = Gauge("pipeline_queue_depth", "Messages waiting to be processed (live: listener queue, backlog: unprocessed in Mongo)", ["queue"])
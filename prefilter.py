@@ -0,0 +1,143 @@
+import math
+import re
+
+# Cheap rule-based pre-classifier, run before the LLM classification.
+#
+# Most messages in the student chats are people looking for a room, chatter or
+# very short texts: they are rejected here without calling the LLM. Messages
+# that look like a clear rental announcement skip the LLM classification and go
+# straight to feature extraction. Everything in between goes to the LLM.
+#
+# The score is a logistic function of keyword and price matches. Thresholds can
+# be tuned with `python prefilter.py`, which evaluates them against the messages
+# already classified by the LLM.
+
+STATS_COLLECTION = "prefilter_stats"
+
+# Can be changed with prefilter_init
+settings = {
+    "enabled": True,
+    "reject_below": 0.1,
+    "accept_above": 0.95,
+}
+
+# (regex, weight)
+RULES = [
+    # people looking for a room
+    (r"#cerc|\bcerco\b|\bcerchiamo\b|\bsto cercando\b|\bstiamo cercando\b|\bin cerca di\b|\blooking for\b|\bsearching for\b", -4.0),
+    # ...but people looking for a flatmate are offering a room
+    (r"\bcoinquilin|\bflatmate|\broommate|\bhousemate", 3.5),
+    # prices
+    (r"\d{2,4}(?:[.,]\d{2})?\s*(?:€|eur\b|euro)|€\s*\d{2,4}", 2.5),
+    (r"\bal mese\b|\bmensil|\bper month\b|/\s*mese\b", 1.0),
+    (r"\bspese\b|\bbollette\b|\butenze\b|\bcondominio\b|\butilities\b|\bbills\b", 1.0),
+    # offers
+    (r"\baffitt(?:o|asi|iamo|a)\b|\bsubaffitt|\bcedo\b|\bliber[ao]\b|\bdisponibile\b|\bfor rent\b|\bavailable\b", 1.5),
+    (r"\bstanz[ae]\b|\bcamer[ae]\b|\bposto letto\b|\bappartamento\b|\bmonolocale\b|\bbilocale\b|\broom\b|\bflat\b|\bapartment\b", 1.0),
+    (r"\bsingola\b|\bdoppia\b|\bsingle\b|\bdouble\b", 0.5),
+    (r"\bcontratto\b|\bcaparra\b|\bdeposito\b|\bcontract\b|\bdeposit\b", 0.5),
+]
+BIAS = -3.0
+MIN_LENGTH = 40
+
+_compiled_rules = [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in RULES]
+
+
+def prefilter_init(enabled=True, reject_below=0.1, accept_above=0.95):
+    settings["enabled"] = enabled
+    settings["reject_below"] = reject_below
+    settings["accept_above"] = accept_above
+
+# Returns the probability (0-1) that the text is a rental announcement
+def prefilter_score(text):
+    text = text or ""
+    if len(text.strip()) < MIN_LENGTH:
+        return 0.0
+    z = BIAS + sum(weight for regex, weight in _compiled_rules if regex.search(text))
+    return 1 / (1 + math.exp(-z))
+
+# LLM calls avoided by a decision: a rejected message skips the classification
+# (or the single pass call), an accepted one skips the classification, which
+# the single pass doesn't have
+def calls_saved(decision, mode):
+    if decision == "reject":
+        return 1
+    if decision == "accept" and mode == "two_stage":
+        return 1
+    return 0
+
+# Returns "reject", "accept" or "llm", and counts the outcome and the LLM calls
+# it avoided, in the pipeline mode used, in the stats
+def prefilter_message(db, text, mode="two_stage"):
+    if not settings["enabled"]:
+        return "llm"
+
+    score = prefilter_score(text)
+    if score < settings["reject_below"]:
+        decision = "reject"
+    elif score > settings["accept_above"]:
+        decision = "accept"
+    else:
+        decision = "llm"
+
+    if db is not None:
+        db[STATS_COLLECTION].update_one(
+            {"_id": "stats"},
+            {"$inc": {decision: 1, "llm_calls_saved": calls_saved(decision, mode)}},
+            upsert=True,
+        )
+    return decision
+
+def prefilter_stats(db):
+    stats = db[STATS_COLLECTION].find_one({"_id": "stats"}) or {}
+    rejected = stats.get("reject", 0)
+    accepted = stats.get("accept", 0)
+    to_llm = stats.get("llm", 0)
+    total = rejected + accepted + to_llm
+    return {
+        "messages": total,
+        "rejected": rejected,
+        "fast_tracked": accepted,
+        "sent_to_llm": to_llm,
+        "llm_calls_saved": stats.get("llm_calls_saved", 0),
+        "skip_rate": (rejected + accepted) / total if total else None,
+    }
+
+# Returns (score, is_rental) for the messages already classified by the LLM.
+# The ones the pre-filter decided are left out, they would only agree with it.
+def score_labeled_messages(db):
+    labeled = db["messages"].find({"__processed": True, "__decided_by": {"$ne": "prefilter"}},
+                                  {"text": 1, "extracted_features": 1})
+    return [(prefilter_score(msg.get("text")), msg.get("extracted_features") is not None) for msg in labeled]
+
+# Evaluates the thresholds against the output of score_labeled_messages
+def evaluate_thresholds(scored, reject_below, accept_above):
+    counts = {"reject": 0, "wrong_reject": 0, "accept": 0, "wrong_accept": 0, "llm": 0}
+    for score, is_rental in scored:
+        if score < reject_below:
+            counts["reject"] += 1
+            counts["wrong_reject"] += is_rental
+        elif score > accept_above:
+            counts["accept"] += 1
+            counts["wrong_accept"] += not is_rental
+        else:
+            counts["llm"] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Evaluate pre-filter thresholds against the LLM classifications")
+    parser.add_argument("--mongo", default="mongodb://mongodb:27017")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["unitn-rents"]
+    scored = score_labeled_messages(db)
+    print("reject_below accept_above | rejected (wrong) | fast-tracked (wrong) | to LLM")
+    for reject_below in [0.02, 0.05, 0.1, 0.2]:
+        for accept_above in [0.9, 0.95, 0.98, 1.0]:
+            c = evaluate_thresholds(scored, reject_below, accept_above)
+            print(f"{reject_below:12} {accept_above:12} | {c['reject']:8} ({c['wrong_reject']}) | "
+                  f"{c['accept']:12} ({c['wrong_accept']}) | {c['llm']}")
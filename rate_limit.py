@@ -0,0 +1,28 @@
+import threading
+import time
+
+# Client-side rate limiting, shared by the LLM clients (API quotas) and the
+# alert sender (Telegram limits).
+
+
+# Token bucket allowing `rate_per_minute` requests per minute, with bursts of
+# at most `burst` requests
+class RateLimiter:
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,74 @@
+from ai_pipeline import process_messages_concurrently, FEATURES_SCHEMA
+from db_helpers import db_get_stale_messages
+
+# Re-extraction of the messages processed with another model or prompt version
+# ("stale"). The re-extraction itself is the "reextract" job in init.py; this is
+# the dry run, which reports what would change without storing anything.
+
+MAX_EXAMPLES = 20
+
+
+def _same(a, b):
+    if isinstance(a, list) and isinstance(b, list):
+        return sorted(map(str, a)) == sorted(map(str, b))
+    return a == b
+
+# {field: [old, new]} for the fields that differ. A message that stops (or
+# starts) being an announcement only has "classification".
+def features_diff(old, new):
+    if (old is None) != (new is None):
+        return {"classification": [old is not None, new is not None]}
+    if old is None:
+        return {}
+    return {
+        field: [old.get(field), new.get(field)]
+        for field in FEATURES_SCHEMA["properties"]
+        if not _same(old.get(field), new.get(field))
+    }
+
+# Re-extracts the `limit` newest stale messages and reports how many would
+# change, and which fields. The new results go to the LLM cache, so the actual
+# re-extraction doesn't call the LLM again for these messages.
+def reextract_diff_report(db, processed_with, limit=50, model="ollama", gemini_key=None, mode="two_stage",
+                          concurrency=4, on_progress=None):
+    report = {
+        "checked": 0,
+        "changed": 0,
+        "failed": 0,
+        "classification_changed": 0,
+        "fields": {},
+        "examples": [],
+    }
+
+    def on_result(message, result):
+        report["checked"] += 1
+        diff = features_diff(message.get("extracted_features"), result["extracted_features"])
+        if diff:
+            report["changed"] += 1
+            if "classification" in diff:
+                report["classification_changed"] += 1
+            for field in diff:
+                report["fields"][field] = report["fields"].get(field, 0) + 1
+            if len(report["examples"]) < MAX_EXAMPLES:
+                report["examples"].append({
+                    "chat_name": message["chat_name"],
+                    "message_id": message["message_id"],
+                    "from": message.get("__processed_with"),
+                    "changes": diff,
+                })
+        if on_progress:
+            on_progress(report)
+
+    def on_error(message, error):
+        report["failed"] += 1
+        if on_progress:
+            on_progress(report)
+
+    messages = db_get_stale_messages(db, processed_with, limit)
+    process_messages_concurrently(db, messages, on_result, on_error,
+                                  model=model,
+                                  gemini_key=gemini_key,
+                                  concurrency=concurrency,
+                                  mode=mode,
+                                  )
+    return report
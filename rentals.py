@@ -0,0 +1,280 @@
+import re
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, ReplaceOne
+
+from ai_pipeline import is_extraction_error
+from geocoding import geocode
+from stats import stats_update_rental, stats_rebuild
+
+# Normalized, typed copy of the rental announcements, materialized from the
+# free-form LLM output in messages.extracted_features. One rental per processed
+# positive message, with the same _id as the message.
+#
+# A rental document looks like:
+# {
+#     "_id": message _id,
+#     "chat_name": "string", "message_id": int, "date": datetime,
+#     "price_per_month": float or None,
+#     "room_type": "single" | "double" | "shared" | None,
+#     "location": "string" or None,
+#     "location_match": gazetteer name or None,
+#     "location_point": GeoJSON Point, missing if the location is unknown,
+#     "target_gender": "male" | "female" | "any" | None,
+#     "target_audience": "students" | "professionals" | "any" | None,
+#     "available_from": datetime or None, "available_from_text": "string" or None,
+#     "contract_duration": "string" or None, "contract_months": int or None,
+#     "utilities_included": bool or None,
+#     "amenities": [AMENITIES], "other": ["string"],
+#     "updated_at": datetime,
+# }
+
+ROOM_TYPES = {
+    "single": ["single", "singola", "singolo", "monolocale", "studio"],
+    "double": ["double", "doppia", "doppio", "posto letto"],
+    "shared": ["shared", "condivisa", "condiviso", "tripla"],
+}
+GENDERS = {
+    "male": ["male", "maschio", "maschi", "ragazzo", "ragazzi", "uomo", "uomini", "m"],
+    "female": ["female", "femmina", "femmine", "ragazza", "ragazze", "studentessa", "studentesse", "donna", "donne", "f"],
+    "any": ["any", "entrambi", "tutti", "both", "mixed"],
+}
+AUDIENCES = {
+    "students": ["students", "student", "studenti", "studente", "studentesse", "studentessa"],
+    "professionals": ["professionals", "professional", "lavoratori", "lavoratore", "lavoratrici", "workers"],
+    "any": ["any", "tutti", "everyone"],
+}
+AMENITIES = {
+    "wifi": ["wifi", "wi-fi", "internet", "fibra", "ftth", "adsl"],
+    "laundry": ["laundry", "lavatrice", "washing machine", "lavanderia", "asciugatrice"],
+    "parking": ["parking", "parcheggio", "posto auto", "garage", "box"],
+    "elevator": ["elevator", "ascensore", "lift"],
+    "balcony": ["balcony", "balcone", "terrazzo", "terrazzino", "terrazza", "poggiolo"],
+    "kitchen": ["kitchen", "cucina", "cucina abitabile", "angolo cottura"],
+}
+
+MONTHS = {
+    "gennaio": 1, "january": 1, "febbraio": 2, "february": 2, "marzo": 3, "march": 3,
+    "aprile": 4, "april": 4, "maggio": 5, "may": 5, "giugno": 6, "june": 6,
+    "luglio": 7, "july": 7, "agosto": 8, "august": 8, "settembre": 9, "september": 9,
+    "ottobre": 10, "october": 10, "novembre": 11, "november": 11, "dicembre": 12, "december": 12,
+}
+IMMEDIATELY = ["subito", "immediately", "now", "da subito", "immediatamente", "asap"]
+
+
+def _canonical(value, synonyms):
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    for canonical, words in synonyms.items():
+        if value in words:
+            return canonical
+    for canonical, words in synonyms.items():
+        if any(len(word) > 2 and re.search(rf"\b{re.escape(word)}\b", value) for word in words):
+            return canonical
+    return None
+
+# 260, "260", "260€", "1.200 euro", "260,50", "250-300" (first number)
+def parse_price(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if value > 0 else None
+    if not isinstance(value, str):
+        return None
+    match = re.search(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:[.,]\d+)?", value)
+    if not match:
+        return None
+    number = match.group(0)
+    if re.fullmatch(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?", number):
+        number = number.replace(".", "")
+    price = float(number.replace(",", "."))
+    return price if price > 0 else None
+
+# "settembre", "1 settembre", "01/09/2025", "2025-09-01", "subito". Month-only
+# dates are resolved to the first occurrence of that month since the announcement.
+def parse_available_from(value, posted_at):
+    if not isinstance(value, str) or not value.strip():
+        return None
+    text = value.strip().lower()
+    posted_at = posted_at or datetime.now(timezone.utc)
+
+    if any(word in text for word in IMMEDIATELY):
+        return datetime(posted_at.year, posted_at.month, posted_at.day)
+
+    try:
+        return datetime.fromisoformat(text[:10])
+    except ValueError:
+        pass
+
+    match = re.search(r"\b(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{2,4}))?\b", text)
+    if match:
+        day, month = int(match.group(1)), int(match.group(2))
+        year = int(match.group(3)) if match.group(3) else None
+        if year is not None and year < 100:
+            year += 2000
+        return _resolve_date(day, month, year, posted_at)
+
+    for name, month in MONTHS.items():
+        if re.search(rf"\b{name}\b", text):
+            day_match = re.search(rf"\b(\d{{1,2}})\s+{name}\b", text)
+            year_match = re.search(r"\b(20\d{2})\b", text)
+            day = int(day_match.group(1)) if day_match else 1
+            return _resolve_date(day, month, int(year_match.group(1)) if year_match else None, posted_at)
+    return None
+
+def _resolve_date(day, month, year, posted_at):
+    if year is None:
+        year = posted_at.year if month >= posted_at.month else posted_at.year + 1
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+# "12 mesi", "1 anno", "6 months", "annuale" -> months
+def parse_contract_months(value):
+    if not isinstance(value, str):
+        return None
+    text = value.lower()
+    match = re.search(r"(\d+)\s*(mes|month)", text)
+    if match:
+        return int(match.group(1))
+    match = re.search(r"(\d+)\s*(ann|year)", text)
+    if match:
+        return int(match.group(1)) * 12
+    if re.search(r"\bannual|\byearly\b", text):
+        return 12
+    if re.search(r"\bsemestral", text):
+        return 6
+    return None
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return [f"{k}: {v}" for k, v in value.items()]
+    return [value]
+
+def _as_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return {"true": True, "yes": True, "si": True, "false": False, "no": False}.get(value.strip().lower())
+    return None
+
+def _as_text(value):
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+# Builds the rental document of a processed message, or returns None if the
+# message is not a rental announcement or its extraction failed
+def normalize_rental(message):
+    features = message.get("extracted_features")
+    if not isinstance(features, dict) or is_extraction_error(features):
+        return None
+
+    amenities = []
+    other = []
+    for amenity in _as_list(features.get("amenities")):
+        canonical = _canonical(amenity, AMENITIES)
+        if canonical:
+            if canonical not in amenities:
+                amenities.append(canonical)
+        elif amenity:
+            other.append(str(amenity))
+    other += [str(o) for o in _as_list(features.get("other")) if o]
+
+    location = _as_text(features.get("location"))
+    place = geocode(location)
+
+    rental = {
+        "_id": message["_id"],
+        "chat_name": message.get("chat_name"),
+        "message_id": message.get("message_id"),
+        "date": message.get("date"),
+        "price_per_month": parse_price(features.get("price_per_month")),
+        "room_type": _canonical(features.get("room_type"), ROOM_TYPES),
+        "location": location,
+        "location_match": place["name"] if place else None,
+        "target_gender": _canonical(features.get("target_gender"), GENDERS),
+        "target_audience": _canonical(features.get("target_audience"), AUDIENCES),
+        "available_from": parse_available_from(features.get("available_from"), message.get("date")),
+        "available_from_text": _as_text(features.get("available_from")),
+        "contract_duration": _as_text(features.get("contract_duration")),
+        "contract_months": parse_contract_months(features.get("contract_duration")),
+        "utilities_included": _as_bool(features.get("utilities_included")),
+        "amenities": amenities,
+        "other": other,
+        "updated_at": datetime.now(timezone.utc),
+    }
+    # the 2dsphere index skips documents without the field, but not null ones
+    if place:
+        rental["location_point"] = place["point"]
+    return rental
+
+
+def rentals_create_indexes(db):
+    db["rentals"].create_index([("price_per_month", ASCENDING), ("_id", ASCENDING)])
+    db["rentals"].create_index([("date", DESCENDING), ("_id", DESCENDING)])
+    db["rentals"].create_index("room_type")
+    db["rentals"].create_index("target_gender")
+    db["rentals"].create_index("amenities")
+    db["rentals"].create_index("available_from")
+    db["rentals"].create_index([("chat_name", ASCENDING), ("message_id", ASCENDING)])
+    db["rentals"].create_index([("location_point", GEOSPHERE)])
+
+# Keeps the rental of a message in sync with its extracted features: creates
+# or replaces it, or deletes it if the message is not an announcement anymore.
+# Returns (rental or None, whether the rental was created)
+def rental_sync_message(db, message):
+    rental = normalize_rental(message)
+    if rental is None:
+        old = db["rentals"].find_one_and_delete({"_id": message["_id"]})
+        if old is not None:
+            stats_update_rental(db, old, None)
+        return None, False
+    old = db["rentals"].find_one_and_replace({"_id": rental["_id"]}, rental, upsert=True)
+    stats_update_rental(db, old, rental)
+    return rental, old is None
+
+# Rebuilds the rentals of all the processed messages, in batches, and the stats.
+# The rentals it didn't write (messages deleted, or no longer announcements)
+# are deleted at the end.
+def rentals_rebuild(db, batch_size=500):
+    # Mongo keeps milliseconds: the rentals written from now on have updated_at >= started
+    started = datetime.now(timezone.utc)
+    started = started.replace(microsecond=started.microsecond // 1000 * 1000)
+    count = 0
+    batch = []
+    for message in db["messages"].find({"extracted_features": {"$ne": None}}):
+        rental = normalize_rental(message)
+        if rental is None:
+            continue
+        batch.append(ReplaceOne({"_id": rental["_id"]}, rental, upsert=True))
+        if len(batch) >= batch_size:
+            db["rentals"].bulk_write(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        db["rentals"].bulk_write(batch, ordered=False)
+        count += len(batch)
+    db["rentals"].delete_many({"updated_at": {"$lt": started}})
+    stats_rebuild(db)
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Rebuild the rentals collection from the processed messages")
+    parser.add_argument("--mongo", default="mongodb://mongodb:27017")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["unitn-rents"]
+    rentals_create_indexes(db)
+    print(f"Rebuilt {rentals_rebuild(db)} rentals.")
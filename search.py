@@ -0,0 +1,95 @@
+import re
+
+from pymongo import TEXT
+from pymongo.errors import OperationFailure
+
+# Full-text search over the message texts, with a MongoDB text index using the
+# Italian stemmer and stop words: "terrazzo" also finds "terrazzi", quoted
+# phrases ("bollette escluse") must appear as they are, and -word excludes a
+# word. Results are ranked by the text score.
+
+SNIPPET_LENGTH = 200
+VOWELS = "aeiouàèéìòù"
+
+
+def search_create_indexes(db):
+    try:
+        db["messages"].create_index([("text", TEXT)], default_language="italian", name="text_italian")
+    except OperationFailure as e:
+        # only one text index per collection
+        print(f"Could not create the messages text index: {e}")
+
+# The words of a query to highlight, as lowercase stems: the trailing vowels
+# are dropped, which is roughly what the Italian stemmer does with inflections
+def query_stems(query):
+    stems = []
+    for word in re.findall(r"(?<![\w-])-?\w+", query.lower()):
+        if word.startswith("-"):
+            continue
+        stem = word.rstrip(VOWELS)
+        stems.append(stem if len(stem) >= 3 else word)
+    return stems
+
+# Returns (snippet, [[start, end]] of the highlighted words in the snippet): a
+# window of the text around the first match, cut at word boundaries
+def make_snippet(text, stems, length=SNIPPET_LENGTH):
+    text = text or ""
+    matches = []
+    if stems:
+        pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, stems)) + r")\w*", re.IGNORECASE)
+        matches = [match.span() for match in pattern.finditer(text)]
+
+    start = max(matches[0][0] - length // 4, 0) if matches else 0
+    if start > 0:
+        space = text.rfind(" ", 0, start)
+        start = space + 1 if space >= 0 else start
+    end = min(start + length, len(text))
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+
+    snippet = text[start:end].replace("\n", " ")
+    highlights = [[s - start, e - start] for s, e in matches if s >= start and e <= end]
+    if start > 0:
+        snippet = "…" + snippet
+        highlights = [[s + 1, e + 1] for s, e in highlights]
+    if end < len(text):
+        snippet += "…"
+    return snippet, highlights
+
+# Returns (results, total) of the messages matching the query, best first.
+# With rentals_only, only the rental announcements, with their rental.
+def search_messages(db, query, limit=20, skip=0, rentals_only=True):
+    mongo_query = {"$text": {"$search": query, "$language": "italian"}}
+    if rentals_only:
+        mongo_query["extracted_features"] = {"$ne": None}
+    total = db["messages"].count_documents(mongo_query)
+    cursor = db["messages"].find(
+        mongo_query,
+        {"score": {"$meta": "textScore"}, "chat_name": 1, "message_id": 1, "date": 1, "text": 1},
+    ).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(limit)
+    messages = list(cursor)
+
+    rentals = {}
+    if rentals_only and messages:
+        projection = {"price_per_month": 1, "room_type": 1, "location": 1, "target_gender": 1}
+        rentals = {r["_id"]: r for r in db["rentals"].find({"_id": {"$in": [m["_id"] for m in messages]}}, projection)}
+
+    stems = query_stems(query)
+    results = []
+    for message in messages:
+        snippet, highlights = make_snippet(message.get("text"), stems)
+        rental = rentals.get(message["_id"])
+        if rental:
+            rental.pop("_id")
+        results.append({
+            "id": str(message["_id"]),
+            "chat_name": message.get("chat_name"),
+            "message_id": message.get("message_id"),
+            "date": message.get("date"),
+            "score": message["score"],
+            "snippet": snippet,
+            "highlights": highlights,
+            "rental": rental,
+        })
+    return results, total
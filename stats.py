@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, UpdateOne
+
+# Aggregate counts read by the dashboard, kept up to date as messages and
+# rentals are written, so that reading them doesn't scan any collection.
+#
+# The stats document:
+# {
+#     "_id": "global",
+#     "messages": int, "processed": int, "rentals": int,
+#     # rentals per room type ("unknown" without one), and a histogram of their
+#     # prices in PRICE_BUCKET euro buckets, for the medians
+#     "room_types": {room_type: {"count": int, "prices": {bucket: int}}},
+# }
+# and the listings per chat per day, in the stats_daily collection:
+# {"_id": "chat_name|YYYY-MM-DD", "chat_name": "string", "day": "YYYY-MM-DD", "listings": int}
+#
+# stats_rebuild recomputes everything from scratch, after bulk changes
+# (rentals_rebuild, restores).
+
+STATS_COLLECTION = "stats"
+DAILY_COLLECTION = "stats_daily"
+STATS_ID = "global"
+
+PRICE_BUCKET = 10
+
+
+def stats_create_indexes(db):
+    db[DAILY_COLLECTION].create_index([("day", ASCENDING)])
+
+def _price_bucket(price):
+    return str(int(round(price / PRICE_BUCKET) * PRICE_BUCKET))
+
+def _room_type(rental):
+    return rental.get("room_type") or "unknown"
+
+def _day(rental):
+    date = rental.get("date")
+    return date.strftime("%Y-%m-%d") if date else None
+
+# Adds the changes to the counters of adding (sign 1) or removing (-1) a rental
+def _rental_deltas(rental, sign, inc, daily_inc):
+    inc["rentals"] = inc.get("rentals", 0) + sign
+    room_type = _room_type(rental)
+    key = f"room_types.{room_type}.count"
+    inc[key] = inc.get(key, 0) + sign
+    if rental.get("price_per_month") is not None:
+        key = f"room_types.{room_type}.prices.{_price_bucket(rental['price_per_month'])}"
+        inc[key] = inc.get(key, 0) + sign
+    if _day(rental):
+        key = (rental.get("chat_name"), _day(rental))
+        daily_inc[key] = daily_inc.get(key, 0) + sign
+
+def stats_inc(db, **counts):
+    counts = {name: value for name, value in counts.items() if value}
+    if counts:
+        db[STATS_COLLECTION].update_one({"_id": STATS_ID}, {"$inc": counts}, upsert=True)
+
+# Updates the stats after a rental was created (old None), replaced, or
+# deleted (new None)
+def stats_update_rental(db, old, new):
+    inc = {}
+    daily_inc = {}
+    if old is not None:
+        _rental_deltas(old, -1, inc, daily_inc)
+    if new is not None:
+        _rental_deltas(new, 1, inc, daily_inc)
+    stats_inc(db, **inc)
+    for (chat_name, day), value in daily_inc.items():
+        if value:
+            db[DAILY_COLLECTION].update_one(
+                {"_id": f"{chat_name}|{day}"},
+                {"$inc": {"listings": value}, "$setOnInsert": {"chat_name": chat_name, "day": day}},
+                upsert=True,
+            )
+
+# Recomputes the stats from the messages and rentals collections
+def stats_rebuild(db, batch_size=500):
+    stats = {
+        "_id": STATS_ID,
+        "messages": db["messages"].count_documents({}),
+        "processed": db["messages"].count_documents({"__processed": True}),
+        "rentals": 0,
+        "room_types": {},
+    }
+    daily = {}
+    projection = {"price_per_month": 1, "room_type": 1, "chat_name": 1, "date": 1}
+    for rental in db["rentals"].find({}, projection, batch_size=batch_size):
+        stats["rentals"] += 1
+        room_type = stats["room_types"].setdefault(_room_type(rental), {"count": 0, "prices": {}})
+        room_type["count"] += 1
+        if rental.get("price_per_month") is not None:
+            bucket = _price_bucket(rental["price_per_month"])
+            room_type["prices"][bucket] = room_type["prices"].get(bucket, 0) + 1
+        if _day(rental):
+            key = (rental.get("chat_name"), _day(rental))
+            daily[key] = daily.get(key, 0) + 1
+
+    db[STATS_COLLECTION].replace_one({"_id": STATS_ID}, stats, upsert=True)
+    db[DAILY_COLLECTION].delete_many({})
+    operations = [
+        UpdateOne({"_id": f"{chat_name}|{day}"},
+                  {"$set": {"chat_name": chat_name, "day": day, "listings": listings}},
+                  upsert=True)
+        for (chat_name, day), listings in daily.items()
+    ]
+    for i in range(0, len(operations), batch_size):
+        db[DAILY_COLLECTION].bulk_write(operations[i:i + batch_size], ordered=False)
+    return stats
+
+def _median(prices):
+    total = sum(prices.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in sorted(prices, key=int):
+        seen += prices[bucket]
+        if seen * 2 >= total:
+            return int(bucket)
+
+# Returns the message and rental counts, with a single document read
+def stats_counts(db):
+    stats = db[STATS_COLLECTION].find_one({"_id": STATS_ID}, {"messages": 1, "processed": 1, "rentals": 1}) or {}
+    return {name: stats.get(name, 0) for name in ("messages", "processed", "rentals")}
+
+# Returns the stats, with the median price per room type (to PRICE_BUCKET
+# euros), and the listings per chat of the last `days` days
+def stats_get(db, days=30):
+    stats = db[STATS_COLLECTION].find_one({"_id": STATS_ID}) or {}
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    daily = db[DAILY_COLLECTION].find({"day": {"$gte": since}, "listings": {"$gt": 0}}, {"_id": 0})
+    return {
+        "messages": stats.get("messages", 0),
+        "processed": stats.get("processed", 0),
+        "rentals": stats.get("rentals", 0),
+        "room_types": {
+            name: {"count": room_type.get("count", 0), "median_price": _median(room_type.get("prices", {}))}
+            for name, room_type in stats.get("room_types", {}).items()
+            if room_type.get("count")
+        },
+        "daily_listings": sorted(daily, key=lambda row: (row["day"], row["chat_name"] or "")),
+    }
+
+def stats_exist(db):
+    return db[STATS_COLLECTION].find_one({"_id": STATS_ID}, {"_id": 1}) is not None
+
+
+if __name__ == "__main__":
+    import argparse
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Recompute the dashboard stats from the messages and rentals")
+    parser.add_argument("--mongo", default="mongodb://mongodb:27017")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["unitn-rents"]
+    stats = stats_rebuild(db)
+    print(f"{stats['messages']} messages, {stats['processed']} processed, {stats['rentals']} rentals.")
@@ -0,0 +1,115 @@
+import asyncio
+import queue
+import threading
+import time
+import traceback
+
+from telethon import events
+from telethon.utils import get_display_name
+
+from db_helpers import db_store_messages_batch, db_store_edited_message
+from metrics import STAGE_SECONDS, TELEGRAM_MESSAGES
+
+# Real-time ingestion: listens for new and edited messages in the active chats
+# on the shared Telegram client, stores them like /sync_messages does, and
+# hands them straight to the LLM pipeline.
+class TelegramListener:
+    def __init__(self, telegram, db, on_message, refresh_interval=60):
+        self.telegram = telegram
+        self.db = db
+        # on_message(chat_name, message_id) is called for every stored message
+        self.on_message = on_message
+        self.refresh_interval = refresh_interval
+        self.active_chats = set()
+        self.active_chats_loaded_at = 0
+        self.running = False
+        self.stats = {"new": 0, "edited": 0}
+
+    def start(self):
+        if self.running:
+            return
+        self.telegram.run(self._register).result()
+        self.running = True
+        print("Telegram listener started.")
+
+    def stop(self):
+        if not self.running:
+            return
+        self.telegram.run(self._unregister).result()
+        self.running = False
+        print("Telegram listener stopped.")
+
+    def status(self):
+        return {"running": self.running, **self.stats}
+
+    async def _register(self, client):
+        client.add_event_handler(self._on_new_message, events.NewMessage())
+        client.add_event_handler(self._on_edited_message, events.MessageEdited())
+
+    async def _unregister(self, client):
+        client.remove_event_handler(self._on_new_message)
+        client.remove_event_handler(self._on_edited_message)
+
+    # Returns the chat name if the event comes from an active chat, None otherwise
+    async def _active_chat_name(self, event):
+        if time.monotonic() - self.active_chats_loaded_at > self.refresh_interval:
+            loop = asyncio.get_running_loop()
+            chats = await loop.run_in_executor(None, lambda: [c["_id"] for c in self.db["active_chats"].find({})])
+            self.active_chats = set(chats)
+            self.active_chats_loaded_at = time.monotonic()
+
+        # same name as dialog.name, used by the sync
+        chat_name = get_display_name(await event.get_chat())
+        return chat_name if chat_name in self.active_chats else None
+
+    async def _on_new_message(self, event):
+        chat_name = await self._active_chat_name(event)
+        if chat_name is None:
+            return
+        loop = asyncio.get_running_loop()
+        with STAGE_SECONDS.time(stage="mongo_write", backend="mongo"):
+            await loop.run_in_executor(None, db_store_messages_batch, self.db, chat_name, [event.message])
+        TELEGRAM_MESSAGES.inc()
+        self.stats["new"] += 1
+        self.on_message(chat_name, event.message.id)
+
+    async def _on_edited_message(self, event):
+        chat_name = await self._active_chat_name(event)
+        if chat_name is None:
+            return
+        loop = asyncio.get_running_loop()
+        with STAGE_SECONDS.time(stage="mongo_write", backend="mongo"):
+            await loop.run_in_executor(None, db_store_edited_message, self.db, chat_name, event.message)
+        self.stats["edited"] += 1
+        self.on_message(chat_name, event.message.id)
+
+    # Forces a reload of the active chats on the next message
+    def refresh_active_chats(self):
+        self.active_chats_loaded_at = 0
+
+
+# Pool of threads processing the messages received by the listener, as soon as
+# they arrive. process_fn(chat_name, message_id) does the actual work.
+class LivePipelineWorker:
+    def __init__(self, process_fn, concurrency=2):
+        self.process_fn = process_fn
+        self.queue = queue.Queue()
+        for i in range(concurrency):
+            threading.Thread(target=self._work, name=f"live-pipeline-{i}", daemon=True).start()
+
+    def enqueue(self, chat_name, message_id):
+        self.queue.put((chat_name, message_id))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _work(self):
+        while True:
+            chat_name, message_id = self.queue.get()
+            try:
+                self.process_fn(chat_name, message_id)
+            except Exception:
+                # the message stays unprocessed, /run_pipeline will retry it
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
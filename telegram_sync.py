@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from db_helpers import db_store_messages_batch, db_get_sync_watermark, db_update_sync_watermark
+from metrics import STAGE_SECONDS, TELEGRAM_MESSAGES
+
+# One long-lived Telethon client, running on its own event loop thread, so that
+# the session file is never opened twice and the Telegram handshake is paid once.
+# Coroutines are submitted to it from any thread with `run`.
+class TelegramService:
+    def __init__(self, api_id, app_hash, session='rent-scraper', flood_sleep_threshold=60):
+        self.api_id = api_id
+        self.app_hash = app_hash
+        self.session = session
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.client = None
+        self.loop = None
+        self._lock = threading.Lock()
+        self._start_lock = None
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="telegram", daemon=True).start()
+
+    async def _get_client(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self.client is None:
+                self.client = TelegramClient(self.session, self.api_id, self.app_hash)
+                self.client.flood_sleep_threshold = self.flood_sleep_threshold
+            if not self.client.is_connected():
+                await self.client.start()
+        return self.client
+
+    # Runs `coro_fn(client)` on the Telegram event loop. Returns a
+    # concurrent.futures.Future, call .result() on it to wait for the result.
+    def run(self, coro_fn):
+        self._ensure_loop()
+
+        async def wrapper():
+            return await coro_fn(await self._get_client())
+
+        return asyncio.run_coroutine_threadsafe(wrapper(), self.loop)
+
+    def disconnect(self, timeout=10):
+        if self.client is not None and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.client.disconnect(), self.loop).result(timeout)
+
+
+# Shared by all the chats synced at the same time: limits how many chats are
+# fetched concurrently, and when Telegram asks to wait (FloodWaitError) pauses
+# all of them, not only the one that got the error.
+class FloodWaitLimiter:
+    def __init__(self, max_concurrent):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.resume_at = 0
+
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Downloads all the messages of a chat newer than its sync watermark, oldest
+# first, storing them in batches as they arrive and moving the watermark after
+# each batch. Going oldest first means an interrupted sync leaves no gaps: the
+# next one restarts from the watermark. A chat without a watermark is downloaded
+# from the start; messages already stored (e.g. by the live listener) are kept.
+async def sync_chat(client, db, dialog, limiter, batch_size=200, on_batch=None, should_stop=None):
+    loop = asyncio.get_running_loop()
+    chat_name = dialog.name
+    stored = 0
+
+    async with limiter.semaphore:
+        while True:
+            await limiter.wait()
+            last_id = await loop.run_in_executor(None, db_get_sync_watermark, db, chat_name)
+            print(f"{chat_name} - last synced id: {last_id}")
+
+            batch = []
+            # time spent downloading each batch, storing excluded
+            fetch_start = time.perf_counter()
+            try:
+                async for msg in client.iter_messages(dialog, min_id=last_id or 0, reverse=True):
+                    batch.append(msg)
+                    if len(batch) >= batch_size:
+                        _observe_fetch(fetch_start, batch)
+                        stored += await _store_batch(loop, db, chat_name, batch, on_batch)
+                        batch = []
+                        if should_stop and await loop.run_in_executor(None, should_stop):
+                            return stored
+                        # a flood wait hit by another chat pauses this one too
+                        await limiter.wait()
+                        fetch_start = time.perf_counter()
+                _observe_fetch(fetch_start, batch)
+                stored += await _store_batch(loop, db, chat_name, batch, on_batch)
+                return stored
+
+            except FloodWaitError as e:
+                # keep what was fetched so far, then resume after the wait
+                _observe_fetch(fetch_start, batch)
+                stored += await _store_batch(loop, db, chat_name, batch, on_batch)
+                print(f"{chat_name} - flood wait of {e.seconds}s")
+                limiter.pause(e.seconds)
+
+def _observe_fetch(start, batch):
+    if batch:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="telegram_fetch", backend="telegram")
+        TELEGRAM_MESSAGES.inc(len(batch))
+
+async def _store_batch(loop, db, chat_name, batch, on_batch):
+    if not batch:
+        return 0
+    with STAGE_SECONDS.time(stage="mongo_write", backend="mongo"):
+        stored = await loop.run_in_executor(None, db_store_messages_batch, db, chat_name, batch)
+    await loop.run_in_executor(None, db_update_sync_watermark, db, chat_name, batch[-1].id)
+    print(f"{chat_name} - stored {stored} messages")
+    if on_batch:
+        await loop.run_in_executor(None, on_batch, chat_name, len(batch), stored)
+    return stored
+
+# Syncs all the active chats, up to `max_concurrent_chats` at a time.
+# The callbacks may block (they update the job in Mongo), so they run in the
+# default executor, off the event loop shared with the live listener.
+# on_start(estimated_total) is called once the chats are known, with an estimate
+# of the number of messages to download. Returns {chat_name: stored messages},
+# or {chat_name: {"error": ...}} for the chats that failed.
+async def sync_active_chats(client, db, active_chats, max_concurrent_chats=3, batch_size=200,
+                            on_start=None, on_batch=None, should_stop=None):
+    limiter = FloodWaitLimiter(max_concurrent_chats)
+    loop = asyncio.get_running_loop()
+
+    dialogs = []
+    estimated_total = 0
+    async for dialog in client.iter_dialogs():
+        if dialog.name not in active_chats:
+            continue
+        dialogs.append(dialog)
+        last_id = await loop.run_in_executor(None, db_get_sync_watermark, db, dialog.name)
+        if dialog.message:
+            # message ids are sequential within a supergroup/channel
+            estimated_total += max(dialog.message.id - (last_id or 0), 0)
+    if on_start:
+        await loop.run_in_executor(None, on_start, estimated_total)
+
+    # a failing chat doesn't stop the others
+    results = await asyncio.gather(*[
+        sync_chat(client, db, dialog, limiter, batch_size, on_batch, should_stop)
+        for dialog in dialogs
+    ], return_exceptions=True)
+
+    stats = {}
+    for dialog, result in zip(dialogs, results):
+        if isinstance(result, BaseException):
+            print(f"{dialog.name} - sync failed: {result!r}")
+            stats[dialog.name] = {"error": str(result)}
+        else:
+            stats[dialog.name] = result
+    return stats
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import mongomock_client
+
+
+@pytest.fixture
+def db():
+    return mongomock_client()["unitn-rents"]
@@ -0,0 +1,94 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_pipeline
+from ai_pipeline import (
+    BatchClassificationScanner,
+    ClassificationScanner,
+    parse_classification_batch,
+    process_batch,
+)
+
+
+def _scan(scanner, chunks):
+    for chunk in chunks:
+        result = scanner.feed(chunk)
+        if result is not None:
+            return result
+    return None
+
+def test_classification_scanner_stops_at_the_first_word():
+    assert _scan(ClassificationScanner(), ["Y", "ES, it is", " an announcement"]) == "YES"
+    assert _scan(ClassificationScanner(), [" no"]) == "NO"
+    assert _scan(ClassificationScanner(), ["MAL", "FORMED, no price"]) == "MALFORMED"
+
+def test_classification_scanner_waits_for_the_end_of_think():
+    chunks = ["<think>", "is it YES or NO?", "</think>", "\nNO"]
+    assert _scan(ClassificationScanner(), chunks) == "NO"
+
+def test_classification_scanner_think_tag_split_across_chunks():
+    assert _scan(ClassificationScanner(), ["<", "think>maybe NO", "</think>", "YES"]) == "YES"
+    assert _scan(ClassificationScanner(), ["<th", "ink>", "hmm</think>", "NO"]) == "NO"
+
+def test_classification_scanner_gives_up_on_other_answers():
+    assert _scan(ClassificationScanner(), ["Sure, here"]) == "SURE, HERE"
+
+def test_parse_classification_batch():
+    assert parse_classification_batch("1: YES\n2: NO\n3: MALFORMED, no price", 3) == [True, False, False]
+    assert parse_classification_batch("[1] NO [2] YES", 2) == [False, True]
+    # newlines stripped
+    assert parse_classification_batch("1. YES 2) NO", 2) == [True, False]
+
+def test_parse_classification_batch_out_of_order():
+    assert parse_classification_batch("2: NO\n3: YES\n1: YES", 3) == [True, False, True]
+
+def test_parse_classification_batch_mismatch():
+    # missing number
+    assert parse_classification_batch("1: YES\n3: NO", 3) is None
+    # duplicated number
+    assert parse_classification_batch("1: YES\n1: NO\n2: NO", 2) is None
+    # number out of range
+    assert parse_classification_batch("1: YES\n2: NO\n3: NO", 2) is None
+    assert parse_classification_batch("I can't answer that", 2) is None
+
+def test_batch_scanner_waits_for_every_verdict():
+    scanner = BatchClassificationScanner(3)
+    assert scanner.feed("<think>3: YES?</think>") is None
+    assert scanner.feed("3: NO\n1: Y") is None
+    assert scanner.feed("ES\n") is None
+    assert scanner.feed("2: NO\nDone.") == "3: NO\n1: YES\n2: NO\nDone."
+
+
+def _batch(*texts):
+    return [{"_id": i, "text": text} for i, text in enumerate(texts)]
+
+def _classify_one(text, model, gemini_key):
+    if text == "broken":
+        raise TimeoutError("timed out")
+    return text.startswith("rent")
+
+def test_process_batch(monkeypatch):
+    monkeypatch.setattr(ai_pipeline, "classify_batch", lambda texts, model, gemini_key: [True, False])
+    monkeypatch.setattr(ai_pipeline, "extract_features", lambda text, model, gemini_key: {"price_per_month": 300})
+    positive, negative = process_batch(None, _batch("rent 300", "hello"), "ollama", None)
+    assert positive()[0]["extracted_features"] == {"price_per_month": 300}
+    assert negative["extracted_features"] is None
+
+def test_process_batch_falls_back_on_mismatch(monkeypatch):
+    monkeypatch.setattr(ai_pipeline, "classify_batch", lambda texts, model, gemini_key: None)
+    monkeypatch.setattr(ai_pipeline, "classify_message", _classify_one)
+    results = process_batch(None, _batch("rent 300", "hello", "broken"), "ollama", None)
+    assert callable(results[0])
+    assert results[1]["extracted_features"] is None
+    assert isinstance(results[2], TimeoutError)
+
+def test_process_batch_falls_back_on_failed_call(monkeypatch):
+    def failing_batch(texts, model, gemini_key):
+        raise ConnectionError("connection refused")
+    monkeypatch.setattr(ai_pipeline, "classify_batch", failing_batch)
+    monkeypatch.setattr(ai_pipeline, "classify_message", _classify_one)
+    results = process_batch(None, _batch("rent 300", "hello"), "ollama", None)
+    assert callable(results[0])
+    assert results[1]["extracted_features"] is None
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_stream import JsonObjectScanner, first_json_object
+
+
+def _feed_all(scanner, chunks):
+    results = [scanner.feed(chunk) for chunk in chunks]
+    return [result for result in results if result is not None]
+
+def test_object_in_one_chunk():
+    assert first_json_object('Here it is: {"a": 1} done') == '{"a": 1}'
+
+def test_object_split_across_chunks():
+    chunks = ['Sure! ```json\n{"price', '_per_month": 350, "amenities": ["wi', 'fi"]}', '\n``` Anything else?']
+    assert _feed_all(JsonObjectScanner(), chunks) == ['{"price_per_month": 350, "amenities": ["wifi"]}']
+
+def test_nested_objects_and_braces_in_strings():
+    chunks = ['{"a": {"b": "}"}, ', '"c": "\\"{"', '}']
+    assert _feed_all(JsonObjectScanner(), chunks) == ['{"a": {"b": "}"}, "c": "\\"{"}']
+
+def test_one_character_at_a_time():
+    text = 'x {"a": [1, {"b": 2}]} {"c": 3}'
+    assert _feed_all(JsonObjectScanner(), list(text)) == ['{"a": [1, {"b": 2}]}']
+
+def test_incomplete_object():
+    scanner = JsonObjectScanner()
+    assert scanner.feed('{"a": 1') is None
+    assert first_json_object("no json here") is None
@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_cache import _short_numbers, cache_lookup, cache_store
+
+ANNOUNCEMENT = "Affittasi stanza singola in via Brennero, libera da settembre. Tel {phone}, {price} euro al mese spese incluse"
+
+
+def _text(price="380", phone="333 1234567"):
+    return ANNOUNCEMENT.format(price=price, phone=phone)
+
+def test_short_numbers():
+    assert _short_numbers("tel 333 1234567, 380 euro") == "380"
+    assert _short_numbers("Singola 350€ tel 347.987.6543") == "350"
+    assert _short_numbers("01/09 380€") == "01 09 380"
+    assert _short_numbers("350/400") == "350 400"
+    assert _short_numbers("prezzi 350 400 500") == "350 400 500"
+    assert _short_numbers("1.200 euro") == "1200"
+
+def test_near_duplicate_with_another_phone_number_hits(db):
+    cache_store(db, _text(), "model", "v1", {"price_per_month": 380})
+    assert cache_lookup(db, _text(phone="347.987.6543"), "model", "v1") == {"price_per_month": 380}
+
+def test_another_price_misses(db):
+    cache_store(db, _text(), "model", "v1", {"price_per_month": 380})
+    assert cache_lookup(db, _text(price="420"), "model", "v1") is None
+    assert cache_lookup(db, _text(price="420 €"), "model", "v1") is None
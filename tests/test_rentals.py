@@ -0,0 +1,76 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_pipeline import empty_features
+from rentals import normalize_rental, parse_available_from, parse_price, rental_sync_message, rentals_rebuild
+
+
+def _message(features):
+    return {
+        "_id": "chat|1",
+        "chat_name": "chat",
+        "message_id": 1,
+        "date": datetime(2024, 9, 1, tzinfo=timezone.utc),
+        "extracted_features": features,
+    }
+
+def test_normalize_rental():
+    features = {**empty_features([]), "price_per_month": "350€", "room_type": "singola"}
+    rental = normalize_rental(_message(features))
+    assert rental["price_per_month"] == 350
+    assert rental["room_type"] == "single"
+
+def test_extraction_error_is_not_a_rental():
+    features = empty_features({"extraction_error": "Failed to parse response", "raw_response": "..."})
+    assert normalize_rental(_message(features)) is None
+
+def test_extraction_error_deletes_the_rental(db):
+    features = {**empty_features([]), "price_per_month": 350}
+    rental, created = rental_sync_message(db, _message(features))
+    assert created and db["rentals"].count_documents({}) == 1
+
+    features = empty_features({"extraction_error": "Failed to parse response", "raw_response": "..."})
+    rental, created = rental_sync_message(db, _message(features))
+    assert rental is None and not created
+    assert db["rentals"].count_documents({}) == 0
+
+def test_parse_price():
+    assert parse_price(350) == 350
+    assert parse_price("350€") == 350
+    assert parse_price("1.200 euro") == 1200
+    assert parse_price("260,50") == 260.5
+    assert parse_price("250-300") == 250
+    assert parse_price(0) is None
+    assert parse_price(True) is None
+    assert parse_price("da concordare") is None
+    assert parse_price(None) is None
+
+def test_parse_available_from():
+    posted_at = datetime(2024, 7, 15, tzinfo=timezone.utc)
+    assert parse_available_from("settembre", posted_at) == datetime(2024, 9, 1)
+    assert parse_available_from("1 settembre", posted_at) == datetime(2024, 9, 1)
+    # a month already past is the next year's
+    assert parse_available_from("febbraio", posted_at) == datetime(2025, 2, 1)
+    assert parse_available_from("01/09/2025", posted_at) == datetime(2025, 9, 1)
+    assert parse_available_from("15/9", posted_at) == datetime(2024, 9, 15)
+    assert parse_available_from("2025-09-01", posted_at) == datetime(2025, 9, 1)
+    assert parse_available_from("da subito", posted_at) == datetime(2024, 7, 15)
+    assert parse_available_from("31/02/2025", posted_at) is None
+    assert parse_available_from("", posted_at) is None
+    assert parse_available_from(None, posted_at) is None
+
+def test_rebuild_deletes_stale_rentals(db):
+    features = {**empty_features([]), "price_per_month": 350}
+    kept = _message(features)
+    gone = {**_message(features), "_id": "chat|2", "message_id": 2}
+    rental_sync_message(db, kept)
+    rental_sync_message(db, gone)
+    db["rentals"].update_many({}, {"$set": {"updated_at": datetime(2024, 9, 1, tzinfo=timezone.utc)}})
+    db["messages"].insert_one(kept)
+    db["messages"].insert_one({**gone, "extracted_features": None})
+
+    assert rentals_rebuild(db) == 1
+    assert [rental["_id"] for rental in db["rentals"].find()] == ["chat|1"]